@@ -0,0 +1,91 @@
+"""
+Проверка инкрементальной синхронизации после задания с промежутком дат
+на локальном мок VK API (см. mock_vk.py). Сначала группа и пользователь
+скачиваются с since, затем обычным запуском с incremental: true —
+второй запуск должен докачать всё, что было раньше since.
+Код выхода 1, если хоть одно фото так и не было скачано.
+
+python benchmarks/date_range.py [--posts 1000] [--since 900]
+"""
+import argparse
+import asyncio
+import logging
+import sys
+import tempfile
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent.joinpath("vk-photos")))
+
+from mock_vk import MockCdn, MockVkApi  # noqa: E402
+
+GROUP_ID = 1
+USER_ID = 1
+# Дата поста и фото с номером N в мок API
+BASE_DATE = 1600000000
+
+
+def count_files(path: Path) -> int:
+    return sum(1 for _ in path.rglob("*.jpg"))
+
+
+async def check(args) -> bool:
+    import main
+    from api import AsyncVkApi
+    from cache import MetadataCache
+    from profiles import ProfileResolver
+    from state import SyncState
+
+    logging.disable(logging.INFO)
+
+    cdn = MockCdn(photo_size=1024)
+    cdn_url = await cdn.start()
+    api = MockVkApi(cdn_url, groups={GROUP_ID: args.posts}, users={USER_ID: args.posts})
+    api_url = await api.start()
+
+    ok = True
+    with tempfile.TemporaryDirectory() as downloads_dir:
+        downloads_dir = Path(downloads_dir)
+        main.DOWNLOADS_DIR = downloads_dir
+        main.utils = main.Utils()
+        main.state = SyncState(downloads_dir)
+        main.store = None
+        main.metadata = MetadataCache()
+        main.profiles = ProfileResolver(main.metadata)
+        main.vk = AsyncVkApi("token", api_url=api_url, rate=1000)
+        main.config["incremental"] = True
+
+        # Фото с номером больше since попадают в промежуток
+        dates = (BASE_DATE + args.since + 1, None)
+        sources = (
+            ("group", lambda dates: main.GroupPhotoDownloader(GROUP_ID, videos=False, dates=dates)),
+            ("user", lambda dates: main.UserPhotoDownloader(USER_ID, parent_dir=downloads_dir, dates=dates))
+        )
+        for name, make_downloader in sources:
+            # Загрузчики возвращают и уже лежащие на диске фото, поэтому считаются файлы
+            before = count_files(downloads_dir)
+            await make_downloader(dates).main()
+            in_range = count_files(downloads_dir) - before
+            await make_downloader(None).main()
+            rest = count_files(downloads_dir) - before - in_range
+            passed = in_range == args.posts - args.since and in_range + rest == args.posts
+            ok = ok and passed
+            print(f"{name:<6} с since: {in_range:>5}  потом инкрементально: {rest:>5}  "
+                  f"из {args.posts}  {'ok' if passed else 'ОШИБКА'}")
+
+        await main.vk.close()
+        main.state.close()
+
+    await cdn.runner.cleanup()
+    await api.runner.cleanup()
+    return ok
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Инкрементальная синхронизация после задания с since")
+    parser.add_argument("--posts", type=int, default=1000, help="постов в группе и фото у пользователя")
+    parser.add_argument("--since", type=int, default=900, help="сколько самых старых фото раньше since")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    sys.exit(0 if asyncio.run(check(parse_args())) else 1)
@@ -0,0 +1,112 @@
+"""
+Пиковое потребление памяти при загрузке фото: чтение ответа целиком
+против потоковой записи кусками. Каждый режим запускается в отдельном
+процессе, картинки раздаёт локальный сервер. Код выхода 1, если в каком-то
+режиме скачались не все фото.
+
+python benchmarks/download_memory.py [количество фото] [размер фото в МБ]
+"""
+import asyncio
+import resource
+import sys
+import tempfile
+from pathlib import Path
+
+import aiofiles
+from aiohttp import web
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent.joinpath("vk-photos")))
+
+import functions  # noqa: E402
+from scheduler import AdaptiveLimiter  # noqa: E402
+from transport import transport  # noqa: E402
+
+PORT = 8781
+
+
+async def legacy_download_photo(session, photo_url, photo_path, index=None, store=None):
+    """
+    download_photo до перехода на потоковую запись. Сигнатура и ответ
+    (код, размер, хеш) как у нынешнего, хеш не считается
+    """
+    async with session.get(photo_url) as response:
+        if response.status != 200:
+            return response.status, 0, None
+        body = await response.read()
+        async with aiofiles.open(photo_path, "wb") as f:
+            await f.write(body)
+        return response.status, len(body), None
+
+
+async def client(mode, count):
+    if mode == "legacy":
+        functions.download_photo = legacy_download_photo
+    photos = [
+        {"owner_id": 1, "id": i, "url": f"http://127.0.0.1:{PORT}/{i}.jpg"}
+        for i in range(count)
+    ]
+    with tempfile.TemporaryDirectory() as photos_path:
+        limiter = AdaptiveLimiter(max_limit=64, per_host=64, initial=64)
+        await functions.download_photos(Path(photos_path), photos, limiter)
+        await transport.close()
+        # Режим, в котором загрузка сломана, показал бы заниженную память
+        downloaded = sum(1 for _ in Path(photos_path).glob("*.jpg"))
+    if downloaded != count:
+        sys.exit(f"скачано {downloaded} фото из {count}")
+    print(get_peak_rss())
+
+
+def get_peak_rss() -> int:
+    """
+    Пиковый RSS процесса в МБ. ru_maxrss на Linux переживает exec и включает память
+    родителя, в котором работает сервер картинок, поэтому сначала берётся VmHWM
+    """
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) // 1024
+    except OSError:
+        pass
+    # ru_maxrss в килобайтах на Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // 1024
+
+
+async def server(count, size):
+    body = b"\xff" * size
+
+    async def image(request):
+        # У каждого фото своё содержимое, иначе загрузчик отбросит их как дубликаты
+        return web.Response(body=request.match_info["name"].encode() + body, content_type="image/jpeg")
+
+    app = web.Application()
+    app.router.add_get("/{name}", image)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", PORT).start()
+
+    failed = False
+    for mode in ("legacy", "stream"):
+        process = await asyncio.create_subprocess_exec(
+            sys.executable, __file__, "--client", mode, str(count),
+            stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
+        )
+        stdout, stderr = await process.communicate()
+        if process.returncode:
+            failed = True
+            error = (stderr.decode().strip().splitlines() or ["?"])[-1]
+            print(f"{mode:<8} ошибка: {error}")
+            continue
+        print(f"{mode:<8} пиковый RSS: {stdout.decode().strip().splitlines()[-1]} МБ")
+
+    await runner.cleanup()
+    return failed
+
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["--client"]:
+        asyncio.run(client(sys.argv[2], int(sys.argv[3])))
+    else:
+        count = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+        size = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+        sys.exit(1 if asyncio.run(server(count, size * 1024 * 1024)) else 0)
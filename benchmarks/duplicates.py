@@ -0,0 +1,90 @@
+"""
+Поиск дубликатов на синтетическом дереве файлов: прежний check_for_duplicates
+(SHA-1, чтение по 1 КБ, один поток) против нового (пул потоков, BLAKE2,
+кеш хешей) при первом и повторном запуске.
+
+python benchmarks/duplicates.py [количество файлов] [множитель размера файлов]
+"""
+import hashlib
+import os
+import random
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent.joinpath("vk-photos")))
+
+from filter import HASH_CACHE_FILENAME, check_for_duplicates  # noqa: E402
+
+SIZES = [1024 * i for i in range(2, 17)]  # По умолчанию файлы 2-16 КБ, чтобы дерево из 100k файлов было ~1 ГБ
+
+
+def legacy_get_hash(filename, first_chunk_only=False):
+    hashobj = hashlib.sha1()
+    with open(filename, "rb") as file_object:
+        if first_chunk_only:
+            hashobj.update(file_object.read(1024))
+        else:
+            for chunk in iter(lambda: file_object.read(1024), b""):
+                hashobj.update(chunk)
+    return hashobj.digest()
+
+
+def legacy_check_for_duplicates(path: Path) -> int:
+    """check_for_duplicates до переделки, без удаления файлов."""
+    hashes_by_size = defaultdict(list)
+    hashes_on_1k = defaultdict(list)
+    hashes_full = {}
+    for file_path in path.glob("*.jpg"):
+        hashes_by_size[file_path.stat().st_size].append(file_path)
+    for size_in_bytes, files in hashes_by_size.items():
+        if len(files) < 2:
+            continue
+        for filename in files:
+            hashes_on_1k[(legacy_get_hash(filename, True), size_in_bytes)].append(filename)
+    duplicates = []
+    for files_list in hashes_on_1k.values():
+        if len(files_list) < 2:
+            continue
+        for filename in files_list:
+            full_hash = legacy_get_hash(filename)
+            if hashes_full.get(full_hash):
+                duplicates.append(filename)
+            else:
+                hashes_full[full_hash] = filename
+    return len(duplicates)
+
+
+def make_tree(path: Path, count: int, scale=1):
+    """Файлы из нескольких размеров с одинаковым началом, каждый десятый — дубликат."""
+    random.seed(0)
+    header = os.urandom(1024)
+    contents = []
+    for i in range(count):
+        if contents and i % 10 == 0:
+            data = random.choice(contents)
+        else:
+            size = random.choice(SIZES) * scale
+            data = header + os.urandom(size - len(header))
+            contents.append(data)
+        path.joinpath(f"{i}.jpg").write_bytes(data)
+
+
+def run(title, func):
+    time_start = time.perf_counter()
+    duplicates = func()
+    print(f"{title:<12} дубликатов: {duplicates:>6}  время: {time.perf_counter() - time_start:.2f} с")
+
+
+if __name__ == "__main__":
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    scale = int(sys.argv[2]) if len(sys.argv) > 2 else 1
+    with tempfile.TemporaryDirectory() as tmp:
+        path = Path(tmp)
+        make_tree(path, count, scale)
+        run("legacy", lambda: legacy_check_for_duplicates(path))
+        run("new (cold)", lambda: check_for_duplicates(path, delete=False))
+        run("new (warm)", lambda: check_for_duplicates(path, delete=False))
+        path.joinpath(HASH_CACHE_FILENAME).unlink()
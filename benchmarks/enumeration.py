@@ -0,0 +1,105 @@
+"""
+Сравнение старого постраничного сбора фотографий пользователя
+с пакетным сбором через execute на локальном мок-API.
+
+python benchmarks/enumeration.py
+"""
+import asyncio
+import json
+import re
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent.joinpath("vk-photos")))
+
+import main  # noqa: E402
+
+
+class MockMethod:
+    def __init__(self, api, name):
+        self.api = api
+        self.name = name
+
+    def __getattr__(self, name):
+        return MockMethod(self.api, f"{self.name}.{name}")
+
+    def __call__(self, **params):
+        return self.api.call(self.name, params)
+
+
+class MockVk:
+    """Имитирует VK API: каждый запрос стоит latency секунд."""
+
+    def __init__(self, photos_count=10000, saved_count=500, latency=0.05):
+        self.albums = {
+            "saved": saved_count,
+            "profile": 50,
+            "wall": photos_count // 2,
+        }
+        self.photos_count = photos_count
+        self.latency = latency
+        self.calls = 0
+
+    def __getattr__(self, name):
+        return MockMethod(self, name)
+
+    async def call(self, method, params):
+        self.calls += 1
+        await asyncio.sleep(self.latency)
+        return self.handle(method, params)
+
+    def handle(self, method, params):
+        if method == "execute":
+            return [
+                self.handle(name, json.loads(args))
+                for name, args in re.findall(r"API\.([\w.]+)\((\{.*?\})\)", params["code"])
+            ]
+        if method == "photos.getAll":
+            total = self.photos_count
+        else:
+            total = self.albums[params["album_id"]]
+        offset, count = params.get("offset", 0), params.get("count", 100)
+        return {
+            "count": total,
+            "items": [self.photo(i) for i in range(offset, min(offset + count, total))]
+        }
+
+    def photo(self, i):
+        return {
+            "id": i,
+            "owner_id": 1,
+            "date": i,
+            "likes": {"count": 0},
+            "sizes": [{"url": f"https://sun9-1.userapi.com/{i}.jpg"}]
+        }
+
+
+async def legacy_get_photos(vk, user_id):
+    """Сбор фотографий до перехода на execute: четыре прохода по 100 фото."""
+    photos = []
+    for album_id in ("saved", "profile", "wall", None):
+        offset = 0
+        while True:
+            if album_id:
+                raw_data = (await vk.photos.get(user_id=user_id, count=100, offset=offset, album_id=album_id))["items"]
+            else:
+                raw_data = (await vk.photos.getAll(owner_id=user_id, count=100, offset=offset))["items"]
+            photos.extend(raw_data)
+            if len(raw_data) < 100:
+                break
+            offset += 100
+    return photos
+
+
+def run(title, func):
+    main.vk = MockVk()
+    time_start = time.perf_counter()
+    photos = asyncio.run(func())
+    elapsed = time.perf_counter() - time_start
+    print(f"{title:<10} фото: {len(photos):>6}  запросов: {main.vk.calls:>4}  время: {elapsed:.2f} с")
+
+
+if __name__ == "__main__":
+    run("legacy", lambda: legacy_get_photos(main.vk, 1))
+    run("execute", lambda: main.UserPhotoDownloader(1).get_photos())
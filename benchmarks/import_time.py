@@ -0,0 +1,84 @@
+"""
+Время импорта main.py, то есть запуска до первого вопроса меню или до начала заданий.
+Импорт повторяется в отдельных процессах, выводятся медиана и самые тяжёлые модули.
+Код выхода 1, если при импорте загрузилась тяжёлая зависимость, которая нужна
+только в отдельных режимах (видео, вход по паролю, поиск похожих фото),
+или если медиана больше --max-ms.
+
+python benchmarks/import_time.py [--runs 7] [--max-ms 1000] [--json итог.json] [--baseline базовый.json]
+"""
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+from pathlib import Path
+
+VK_PHOTOS_DIR = Path(__file__).resolve().parent.parent.joinpath("vk-photos")
+
+# Загружаются только в тех режимах, где нужны
+LAZY_MODULES = ("yt_dlp", "vk_api", "requests", "numpy", "PIL", "pytrovich", "tqdm")
+
+
+def measure() -> dict:
+    """{модуль: собственное и суммарное время импорта в мкс} для одного запуска"""
+    stderr = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import main"],
+        cwd=VK_PHOTOS_DIR, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, check=True, text=True
+    ).stderr
+    modules = {}
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        # Отступ показывает вложенность: два пробела — импорт прямо из main
+        modules[name.strip()] = {
+            "self": int(self_us),
+            "cumulative": int(cumulative_us),
+            "depth": (len(name) - len(name.lstrip())) // 2
+        }
+    return modules
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Бенчмарк времени импорта main.py")
+    parser.add_argument("--runs", type=int, default=7)
+    parser.add_argument("--max-ms", type=float, help="допустимая медиана времени импорта")
+    parser.add_argument("--top", type=int, default=10, help="сколько самых тяжёлых импортов показать")
+    parser.add_argument("--json", type=Path, help="сохранить результат для сравнения")
+    parser.add_argument("--baseline", type=Path, help="сравнить с сохранённым результатом")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    runs = [measure() for _ in range(args.runs)]
+    total_ms = statistics.median(run["main"]["cumulative"] for run in runs) / 1000
+
+    line = f"main: {total_ms:.1f} мс (медиана {args.runs} запусков)"
+    if args.baseline:
+        previous = json.loads(args.baseline.read_text())["main_ms"]
+        line += f", было {previous:.1f} мс ({(total_ms - previous) / previous * 100:+.1f}%)"
+    print(line)
+
+    last = runs[-1]
+    direct = sorted(
+        ((name, module["cumulative"]) for name, module in last.items() if module["depth"] == 1),
+        key=lambda item: item[1], reverse=True
+    )
+    print("Самые тяжёлые импорты из main:")
+    for name, cumulative in direct[:args.top]:
+        print(f"  {name:<30} {cumulative / 1000:>8.1f} мс")
+
+    loaded = sorted({name.split(".")[0] for name in last} & set(LAZY_MODULES))
+    if args.json:
+        args.json.write_text(json.dumps({"main_ms": total_ms, "lazy_loaded": loaded}, indent=2))
+
+    failed = False
+    if loaded:
+        print("При запуске загружаются модули, которые должны загружаться по требованию: " + ", ".join(loaded))
+        failed = True
+    if args.max_ms is not None and total_ms > args.max_ms:
+        print(f"Импорт дольше {args.max_ms:.0f} мс")
+        failed = True
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,215 @@
+"""
+Локальные заменители VK для бенчмарков: мок VK API и сервер картинок вместо CDN.
+Оба умеют добавлять задержку, а сервер картинок — ещё ошибки 500 и ответы 429.
+Мок API вместо 429 отвечает ошибкой 6 (Too many requests per second), как настоящий VK,
+а вместо 500 — ошибкой 10 (Internal server error), которую клиент не повторяет.
+"""
+import asyncio
+import json
+import random
+import re
+from collections import Counter
+
+from aiohttp import web
+
+
+# Размеры фото, которые отдаёт мок API; сервер картинок отдаёт photo_size байт за самый большой
+PHOTO_SIZES = {"m": (130, 98), "x": (604, 453), "w": (2560, 1920), "y": (807, 605), "z": (1280, 960)}
+
+
+def make_jpeg(size: int, tag: str) -> bytes:
+    """У каждого фото своё содержимое, иначе загрузчик отбросит их как дубликаты"""
+    body = b"\xff\xd8" + tag.encode()
+    return body + b"\x00" * max(0, size - len(body) - 2) + b"\xff\xd9"
+
+
+class Faults:
+    def __init__(self, latency=0.0, errors=0.0, throttle=0.0, seed=0):
+        self.latency = latency
+        self.errors = errors
+        self.throttle = throttle
+        self.random = random.Random(seed)
+
+    async def apply(self):
+        """Ждёт задержку (±50%) и решает, чем ответить: "error", "throttle" или None"""
+        if self.latency:
+            await asyncio.sleep(self.latency * self.random.uniform(0.5, 1.5))
+        value = self.random.random()
+        if value < self.errors:
+            return "error"
+        if value < self.errors + self.throttle:
+            return "throttle"
+        return None
+
+
+async def start_app(app: web.Application):
+    """Запускает приложение на свободном порту, возвращает (runner, базовый адрес)"""
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    return runner, f"http://127.0.0.1:{port}"
+
+
+class MockCdn:
+    """Раздаёт /<owner_id>/<id>_<тип размера>.jpg, самый большой размер — photo_size байт"""
+
+    def __init__(self, photo_size=64 * 1024, faults: Faults = None):
+        self.photo_size = photo_size
+        self.faults = faults or Faults()
+        self.requests = 0
+        self.bytes_sent = 0
+        self.statuses = Counter()
+
+    async def handle(self, request):
+        self.requests += 1
+        fault = await self.faults.apply()
+        if fault == "error":
+            self.statuses[500] += 1
+            return web.Response(status=500)
+        if fault == "throttle":
+            self.statuses[429] += 1
+            return web.Response(status=429)
+        name = request.match_info["name"]
+        width, height = PHOTO_SIZES.get(name[:-len(".jpg")].rpartition("_")[2], (2560, 1920))
+        body = make_jpeg(self.photo_size * width * height // (2560 * 1920), name)
+        self.statuses[200] += 1
+        self.bytes_sent += len(body)
+        return web.Response(body=body, content_type="image/jpeg")
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get("/{owner_id}/{name}", self.handle)
+        self.runner, self.url = await start_app(app)
+        return self.url
+
+
+class MockVkApi:
+    """
+    Мок VK API с методами, которые нужны загрузчикам:
+    wall.get, photos.get, photos.getAll, messages.getHistoryAttachments, execute,
+    а также users.get, groups.getById, messages.getConversationsById и video.get.
+    groups — {id группы: количество постов (по фото в каждом)},
+    users — {id пользователя: количество фото}, chats — {peer_id: количество вложений}
+    """
+
+    def __init__(self, cdn_url: str, groups=None, users=None, chats=None, faults: Faults = None):
+        self.cdn_url = cdn_url
+        self.groups = groups or {}
+        self.users = users or {}
+        self.chats = chats or {}
+        self.faults = faults or Faults()
+        self.requests = 0  # HTTP-запросов
+        self.calls = Counter()  # Вызовов методов, включая вызовы внутри execute
+        self.throttled = 0
+        self.errors = 0
+
+    def photo(self, owner_id: int, photo_id: int) -> dict:
+        return {
+            "id": photo_id,
+            "owner_id": owner_id,
+            "date": 1600000000 + photo_id,
+            "likes": {"count": 0},
+            # Как у VK, порядок размеров не обязательно по возрастанию
+            "sizes": [
+                {"type": size_type, "width": width, "height": height,
+                 "url": f"{self.cdn_url}/{owner_id}/{photo_id}_{size_type}.jpg"}
+                for size_type, (width, height) in PHOTO_SIZES.items()
+            ]
+        }
+
+    @staticmethod
+    def page(total: int, params: dict) -> range:
+        offset, count = int(params.get("offset", 0)), int(params.get("count", 100))
+        return range(offset, min(offset + count, total))
+
+    def call(self, method: str, params: dict):
+        self.calls[method] += 1
+        if method == "execute":
+            return [
+                self.call(name, json.loads(args))
+                for name, args in re.findall(r"API\.([\w.]+)\((\{.*?\})\)", params["code"])
+            ]
+
+        if method == "users.get":
+            user_ids = [int(user_id) for user_id in str(params["user_ids"]).split(",")]
+            return [{
+                "id": user_id,
+                "first_name": "Пользователь",
+                "last_name": str(user_id),
+                "sex": 2,
+                "is_closed": False,
+                "can_access_closed": True,
+                "photo_max_orig": f"{self.cdn_url}/{user_id}/0.jpg"
+            } for user_id in user_ids if user_id in self.users]
+
+        if method == "photos.getAll":
+            owner_id = int(params["owner_id"])
+            total = self.users.get(owner_id, 0)
+            # Как у VK, от новых фото к старым
+            return {"count": total, "items": [self.photo(owner_id, total - i) for i in self.page(total, params)]}
+
+        if method == "photos.get":
+            # Сохранённые фото: у мок-пользователей их нет
+            return {"count": 0, "items": []}
+
+        if method == "groups.getById":
+            group_id = int(params["group_id"])
+            return [{"id": group_id, "name": f"Группа {group_id}", "is_closed": 0}] if group_id in self.groups else []
+
+        if method == "wall.get":
+            group_id = -int(params["owner_id"])
+            total = self.groups.get(group_id, 0)
+            return {"count": total, "items": [{
+                "id": total - i,
+                "date": 1600000000 + total - i,
+                "marked_as_ads": 0,
+                "attachments": [{"type": "photo", "photo": self.photo(-group_id, total - i)}]
+            } for i in self.page(total, params)]}
+
+        if method == "video.get":
+            return {"count": 0, "items": []}
+
+        if method == "messages.getConversationsById":
+            peer_id = int(params["peer_ids"])
+            if peer_id not in self.chats:
+                return {"count": 0, "items": []}
+            return {"count": 1, "items": [{"chat_settings": {"title": f"Беседа {peer_id}"}}]}
+
+        if method == "messages.getHistoryAttachments":
+            peer_id = int(params["peer_id"])
+            total = self.chats.get(peer_id, 0)
+            start = int(params.get("start_from") or 0)
+            end = min(start + int(params.get("count", 200)), total)
+            return {
+                "items": [
+                    {"message_id": i, "attachment": {"type": "photo", "photo": self.photo(peer_id, i + 1)}}
+                    for i in range(start, end)
+                ],
+                "next_from": str(end) if end < total else None
+            }
+
+        raise KeyError(method)
+
+    async def handle(self, request):
+        self.requests += 1
+        params = dict(await request.post())
+        fault = await self.faults.apply()
+        if fault == "error":
+            self.errors += 1
+            return web.json_response({"error": {"error_code": 10, "error_msg": "Internal server error"}})
+        if fault == "throttle":
+            self.throttled += 1
+            return web.json_response({"error": {"error_code": 6, "error_msg": "Too many requests per second"}})
+        try:
+            return web.json_response({"response": self.call(request.match_info["method"], params)})
+        except KeyError as e:
+            return web.json_response({"error": {"error_code": 3, "error_msg": f"Unknown method passed: {e}"}})
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_post("/method/{method}", self.handle)
+        self.runner, url = await start_app(app)
+        self.url = url + "/method/"
+        return self.url
@@ -0,0 +1,194 @@
+"""
+Сквозные сценарии на локальном мок VK API и сервере картинок (см. mock_vk.py):
+большая группа, много пользователей, большая беседа.
+Для каждого сценария выводятся фото/с, МБ/с, число запросов к API,
+p50/p99 времени загрузки фото, число открытых HTTP-соединений
+и доля повторно использованных, пиковая память. Каждый сценарий
+запускается в отдельном процессе, чтобы пиковая память не смешивалась.
+
+python benchmarks/scenarios.py [сценарий ...] [--scale 1] [--cdn-latency 0.02] [--cdn-errors 0.01]
+    [--cdn-throttle 0.01] [--size max] [--api-latency 0.03] [--api-errors 0.01] [--api-throttle 0.01] [--json итог.json] [--baseline базовый.json]
+"""
+import argparse
+import asyncio
+import json
+import logging
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent.joinpath("vk-photos")))
+
+from mock_vk import Faults, MockCdn, MockVkApi  # noqa: E402
+
+SCENARIOS = ("big_group", "many_users", "big_chat")
+GROUP_ID = 1
+CHAT_PEER_ID = 2000000001
+
+
+def get_sources(name: str, scale: float) -> dict:
+    if name == "big_group":
+        return {"groups": {GROUP_ID: int(5000 * scale)}}
+    if name == "many_users":
+        return {"users": {user_id: int(200 * scale) for user_id in range(1, 51)}}
+    return {"chats": {CHAT_PEER_ID: int(10000 * scale)}}
+
+
+def percentile(values: list, q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+
+async def run(name: str, args) -> dict:
+    import main
+    from api import AsyncVkApi
+    from cache import MetadataCache
+    from profiles import ProfileResolver
+    from scheduler import AdaptiveLimiter
+    from sizes import SizePolicy
+    from transport import transport
+    from state import SyncState
+
+    class RecordingLimiter(AdaptiveLimiter):
+        latencies = []
+
+        async def release(self, host, latency, status, owner=None):
+            self.latencies.append(latency)
+            await super().release(host, latency, status, owner)
+
+    logging.disable(logging.INFO)
+
+    cdn = MockCdn(args.photo_size, Faults(args.cdn_latency, args.cdn_errors, args.cdn_throttle, seed=1))
+    cdn_url = await cdn.start()
+    api = MockVkApi(cdn_url, faults=Faults(args.api_latency, args.api_errors, args.api_throttle, seed=2),
+                    **get_sources(name, args.scale))
+    api_url = await api.start()
+
+    with tempfile.TemporaryDirectory() as downloads_dir:
+        downloads_dir = Path(downloads_dir)
+        # Загрузчики берут всё окружение из глобальных переменных main
+        main.DOWNLOADS_DIR = downloads_dir
+        main.utils = main.Utils()
+        main.state = SyncState(downloads_dir)
+        main.store = None
+        main.metadata = MetadataCache()
+        main.profiles = ProfileResolver(main.metadata)
+        main.vk = AsyncVkApi("token", api_url=api_url, rate=args.api_rate)
+        # Все фото отдаёт один хост, поэтому ограничение на хост не действует
+        main.default_size_policy = SizePolicy.parse(args.size)
+        main.limiter = RecordingLimiter(max_limit=args.concurrency, per_host=args.concurrency)
+
+        if name == "big_group":
+            downloader = main.GroupPhotoDownloader(GROUP_ID, videos=False)
+        elif name == "many_users":
+            downloader = main.UsersPhotoDownloader(list(api.users), parent_dir=downloads_dir)
+        else:
+            downloader = main.ChatPhotoDownloader(CHAT_PEER_ID - 2000000000)
+
+        time_start = time.perf_counter()
+        error = None
+        try:
+            photos_count = await downloader.main()
+        except Exception as e:
+            # Неповторяемая ошибка API прерывает сценарий — это тоже результат
+            photos_count, error = 0, repr(e)
+        elapsed = time.perf_counter() - time_start
+
+        downloaded = sum(
+            file.stat().st_size for file in downloads_dir.rglob("*.jpg")
+        )
+        await main.vk.close()
+        main.state.close()
+
+    await cdn.runner.cleanup()
+    await api.runner.cleanup()
+
+    return {
+        "scenario": name,
+        "photos": photos_count,
+        "seconds": round(elapsed, 2),
+        "photos_per_second": round(photos_count / elapsed, 1),
+        "mb_per_second": round(downloaded / elapsed / 1024 / 1024, 2),
+        "api_requests": api.requests,
+        "api_calls": sum(api.calls.values()),
+        "api_throttled": api.throttled,
+        "api_errors": api.errors,
+        "cdn_requests": cdn.requests,
+        "cdn_errors": cdn.statuses[500] + cdn.statuses[429],
+        "latency_p50": round(percentile(RecordingLimiter.latencies, 0.5), 4),
+        "latency_p99": round(percentile(RecordingLimiter.latencies, 0.99), 4),
+        "http_connections": transport.report()["new"],
+        "http_reuse_ratio": round(transport.report()["reuse_ratio"], 3),
+        # ru_maxrss в килобайтах на Linux
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // 1024,
+        "error": error
+    }
+
+
+def print_table(results: list, baseline: dict):
+    columns = ("photos", "seconds", "photos_per_second", "mb_per_second", "api_requests",
+               "api_calls", "api_throttled", "api_errors", "cdn_errors", "latency_p50", "latency_p99",
+               "http_connections", "http_reuse_ratio", "peak_rss_mb")
+    for result in results:
+        print(f"\n{result['scenario']}")
+        if result.get("error"):
+            print(f"  прервано ошибкой: {result['error']}")
+        previous = baseline.get(result["scenario"], {})
+        for column in columns:
+            line = f"  {column:<18} {result[column]:>10}"
+            if previous.get(column):
+                change = (result[column] - previous[column]) / previous[column] * 100
+                line += f"   было {previous[column]:>10} ({change:+.1f}%)"
+            print(line)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Сквозные бенчмарки на мок VK API")
+    parser.add_argument("scenarios", nargs="*", help="{} (по умолчанию все)".format(", ".join(SCENARIOS)))
+    parser.add_argument("--scale", type=float, default=1.0, help="множитель размера сценариев")
+    parser.add_argument("--photo-size", type=int, default=64 * 1024, help="байт в самом большом размере фото")
+    parser.add_argument("--size", default="max", help="какой размер фото скачивать (max, long_edge:N, type:T)")
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--api-rate", type=float, default=100, help="запросов к API в секунду")
+    parser.add_argument("--api-latency", type=float, default=0.03)
+    parser.add_argument("--api-errors", type=float, default=0.0, help="доля ответов с ошибкой 10 (не повторяется)")
+    parser.add_argument("--api-throttle", type=float, default=0.0, help="доля ответов с ошибкой 6")
+    parser.add_argument("--cdn-latency", type=float, default=0.02)
+    parser.add_argument("--cdn-errors", type=float, default=0.0, help="доля ответов 500")
+    parser.add_argument("--cdn-throttle", type=float, default=0.0, help="доля ответов 429")
+    parser.add_argument("--json", type=Path, help="сохранить результаты для сравнения")
+    parser.add_argument("--baseline", type=Path, help="сравнить с сохранёнными результатами")
+    parser.add_argument("--run", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error("неизвестные сценарии: {}".format(", ".join(sorted(unknown))))
+    args.scenarios = args.scenarios or list(SCENARIOS)
+    return args
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.run:
+        print(json.dumps(asyncio.run(run(args.run, args))))
+        sys.exit(0)
+
+    results = []
+    for name in args.scenarios:
+        output = subprocess.run(
+            [sys.executable, __file__, "--run", name] + sys.argv[1:],
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True, text=True
+        ).stdout
+        results.append(json.loads(output.strip().splitlines()[-1]))
+
+    baseline = {}
+    if args.baseline:
+        baseline = {result["scenario"]: result for result in json.loads(args.baseline.read_text())}
+    print_table(results, baseline)
+    if args.json:
+        args.json.write_text(json.dumps(results, ensure_ascii=False, indent=2))
@@ -0,0 +1,74 @@
+"""
+Поиск похожих картинок: скорость подсчёта перцептивных хешей
+и поиска по индексу в сравнении с полным перебором пар.
+
+python benchmarks/similar.py [количество картинок]
+"""
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+from PIL import Image
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent.joinpath("vk-photos")))
+
+from similar import HammingIndex, find_similar, hamming, hash_batch  # noqa: E402
+
+
+def make_images(path: Path, count: int) -> int:
+    """Случайные плавные картинки 512x512, каждая пятая ещё раз пережата в 256x256."""
+    rng = np.random.default_rng(0)
+    copies = 0
+    for i in range(count):
+        pattern = rng.integers(0, 256, (8, 8, 3), dtype=np.uint8)
+        image = Image.fromarray(pattern).resize((512, 512), Image.BICUBIC)
+        image.save(path.joinpath(f"{i}.jpg"), quality=90)
+        if i % 5 == 0:
+            image.resize((256, 256)).save(path.joinpath(f"{i}_small.jpg"), quality=60)
+            copies += 1
+    return copies
+
+
+def brute_force(hashes, threshold):
+    kept = []
+    found = 0
+    for value in hashes:
+        if any(hamming(value, other) <= threshold for other in kept):
+            found += 1
+        else:
+            kept.append(value)
+    return found
+
+
+if __name__ == "__main__":
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    with tempfile.TemporaryDirectory() as tmp:
+        path = Path(tmp)
+        copies = make_images(path, count)
+        files = sorted(str(file_path) for file_path in path.glob("*.jpg"))
+
+        for method in ("dhash", "phash"):
+            time_start = time.perf_counter()
+            hashes = [value for i in range(0, len(files), 256) for value in hash_batch(files[i:i + 256], method)]
+            elapsed = time.perf_counter() - time_start
+            print(f"{method}: {len(files) / elapsed:.0f} картинок/с в одном процессе")
+
+        time_start = time.perf_counter()
+        similar = find_similar(path, method="dhash")
+        print(f"find_similar: {len(similar)} похожих из {copies} пережатых копий, "
+              f"{time.perf_counter() - time_start:.2f} с")
+
+        time_start = time.perf_counter()
+        index = HammingIndex(4)
+        found = 0
+        for value in hashes:
+            if index.query(value) is None:
+                index.add(value)
+            else:
+                found += 1
+        print(f"индекс:  {found} совпадений, {time.perf_counter() - time_start:.3f} с")
+
+        time_start = time.perf_counter()
+        print(f"перебор: {brute_force(hashes, 4)} совпадений, {time.perf_counter() - time_start:.3f} с")
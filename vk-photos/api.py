@@ -0,0 +1,364 @@
+import json
+import time
+import random
+import asyncio
+import logging
+
+import aiohttp
+
+from metrics import metrics
+from transport import transport
+
+
+API_URL = "https://api.vk.com/method/"
+API_VERSION = "5.131"
+
+EXECUTE_LIMIT = 25  # Максимум обращений к API внутри одного execute
+# Сколько элементов запрашивать в одном execute: фото со всеми размерами занимают
+# 1-2 КБ каждое, а слишком большой ответ VK отклоняет ошибкой 13
+EXECUTE_ITEMS_LIMIT = 1000
+PAGE_SIZE = 100
+HISTORY_PAGE_SIZE = 200  # Максимум для messages.getHistoryAttachments
+
+API_RATE = 3  # VK разрешает 3 запроса в секунду на токен
+MAX_RETRIES = 5
+# Коды ошибок, после которых запрос стоит повторить, и базовая пауза перед повтором
+RETRY_DELAYS = {
+    6: 1.0,  # Too many requests per second
+    9: 5.0   # Flood control
+}
+NETWORK_RETRY_DELAY = 0.5  # Базовая пауза перед повтором после обрыва соединения или таймаута
+RESPONSE_TOO_LARGE = 13  # Ошибка, после которой execute делится на пачки поменьше
+# Ошибки, после которых токен на время убирается из пула, и на сколько секунд
+BENCH_TIMES = {
+    5: 600,    # User authorization failed
+    9: 60,     # Flood control
+    14: 300,   # Captcha needed
+    29: 3600   # Rate limit reached
+}
+
+
+class VkApiError(Exception):
+    def __init__(self, error: dict):
+        self.code = error.get("error_code")
+        self.error = error
+        super().__init__("[{}] {}".format(self.code, error.get("error_msg")))
+
+
+class TokenBucket:
+    """
+    Ограничивает частоту запросов одного токена.
+    После ошибки 6/9 частота снижается, а с каждым успешным запросом
+    понемногу возвращается к максимальной, поэтому постраничные обходы
+    идут с максимальной частотой, которую VK реально пропускает
+    """
+
+    def __init__(self, rate=API_RATE):
+        self.max_rate = rate
+        self.rate = rate
+        # Без накопления: запросы идут равномерно, пачка не превысит лимит в пределах секунды
+        self.capacity = 1
+        self.tokens = 1
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def delay(self) -> float:
+        """Сколько секунд осталось до следующего разрешённого запроса"""
+        tokens = min(self.capacity, self.tokens + (time.monotonic() - self.updated) * self.rate)
+        return max(0.0, (1 - tokens) / self.rate)
+
+    def slow_down(self):
+        self.rate = max(self.max_rate / 4, self.rate * 0.7)
+        self.tokens = 0
+
+    def speed_up(self):
+        self.rate = min(self.max_rate, self.rate + 0.05)
+
+
+class ApiToken:
+    """Токен из пула со своим ограничением частоты и состоянием"""
+
+    def __init__(self, token: str, rate=API_RATE):
+        self.token = token
+        self.bucket = TokenBucket(rate)
+        self.pending = 0  # Запросов ждут своей очереди в bucket
+        self.benched_until = 0.0
+        self.last_error = None
+
+    def is_healthy(self, now: float) -> bool:
+        return self.benched_until <= now
+
+    def get_wait(self) -> float:
+        """Примерное время ожидания нового запроса с учётом уже ждущих"""
+        return self.bucket.delay() + self.pending / self.bucket.rate
+
+    def bench(self, code: int):
+        self.benched_until = time.monotonic() + BENCH_TIMES[code]
+        self.last_error = code
+
+    def __repr__(self):
+        # Сам токен в логи не попадает
+        return f"...{self.token[-4:]}"
+
+
+def get_retry_delay(delay: float, attempt: int) -> float:
+    """Экспоненциальная пауза со случайным разбросом, чтобы повторы не шли одной волной"""
+    return delay * 2 ** attempt * random.uniform(0.5, 1.5)
+
+
+class VkApiMethod:
+    """Позволяет обращаться к методам API как к атрибутам: await vk.users.get(...)"""
+
+    def __init__(self, vk, method: str):
+        self._vk = vk
+        self._method = method
+
+    def __getattr__(self, name):
+        return VkApiMethod(self._vk, f"{self._method}.{name}")
+
+    def __call__(self, **kwargs):
+        return self._vk.method(self._method, kwargs)
+
+
+class AsyncVkApi:
+    """
+    Асинхронный клиент VK API.
+    Все запросы идут через общую сессию aiohttp (transport) с keep-alive соединениями,
+    поэтому несколько запросов могут выполняться одновременно.
+    Можно передать список токенов: каждый запрос уходит токену, который освободится
+    раньше остальных, так что пропускная способность растёт с числом токенов.
+    Частота запросов каждого токена ограничена TokenBucket, ошибки 6 и 9, обрывы соединения
+    и таймауты повторяются с паузой.
+    Токен, получивший капчу, ошибку авторизации или flood control, на время
+    отстраняется (BENCH_TIMES), а по истечении этого времени снова проверяется запросом
+    """
+
+    def __init__(self, token, api_url=API_URL, version=API_VERSION, rate=API_RATE):
+        tokens = [token] if isinstance(token, str) else list(token)
+        self.tokens = [ApiToken(token, rate) for token in tokens]
+        self.api_url = api_url
+        self.version = version
+
+    def __getattr__(self, name):
+        return VkApiMethod(self, name)
+
+    def get_session(self) -> aiohttp.ClientSession:
+        return transport.get_session()
+
+    async def close(self):
+        await transport.close()
+
+    @property
+    def tokens_count(self) -> int:
+        return len(self.tokens)
+
+    def has_healthy_token(self) -> bool:
+        now = time.monotonic()
+        return any(token.is_healthy(now) for token in self.tokens)
+
+    def get_token(self) -> ApiToken:
+        now = time.monotonic()
+        healthy = [token for token in self.tokens if token.is_healthy(now)]
+        if not healthy:
+            # Все токены отстранены — проверяем тот, который вернётся раньше других
+            return min(self.tokens, key=lambda token: token.benched_until)
+        return min(healthy, key=ApiToken.get_wait)
+
+    async def acquire_token(self) -> ApiToken:
+        while True:
+            token = self.get_token()
+            token.pending += 1
+            try:
+                await token.bucket.acquire()
+            finally:
+                token.pending -= 1
+            # Пока запрос ждал очереди, токен могли отстранить
+            if token.is_healthy(time.monotonic()) or not self.has_healthy_token():
+                return token
+
+    async def method(self, method: str, values=None):
+        values = {
+            key: ",".join(map(str, value)) if isinstance(value, (list, tuple)) else value
+            for key, value in (values or {}).items()
+        }
+        values["v"] = self.version
+
+        for attempt in range(MAX_RETRIES + 1):
+            token = await self.acquire_token()
+            values["access_token"] = token.token
+            try:
+                with metrics.timer("api_latency_seconds", method=method):
+                    async with self.get_session().post(self.api_url + method, data=values) as response:
+                        data = await response.json(content_type=None)
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                metrics.inc("api_network_errors_total", method=method)
+                if attempt == MAX_RETRIES:
+                    raise
+                await asyncio.sleep(get_retry_delay(NETWORK_RETRY_DELAY, attempt))
+                continue
+            metrics.inc("api_calls_total", method=method)
+
+            if "error" not in data:
+                token.bucket.speed_up()
+                token.benched_until = 0.0
+                return data["response"]
+
+            error = VkApiError(data["error"])
+            metrics.inc("api_errors_total", method=method, code=error.code)
+            if error.code in BENCH_TIMES and len(self.tokens) > 1:
+                token.bench(error.code)
+                logging.warning(f"Токен {token} отстранён на {BENCH_TIMES[error.code]} секунд: {error}")
+                # Сразу повторяем запрос с другим токеном
+                if self.has_healthy_token() and attempt < MAX_RETRIES:
+                    continue
+            if error.code not in RETRY_DELAYS or attempt == MAX_RETRIES:
+                raise error
+            token.bucket.slow_down()
+            await asyncio.sleep(get_retry_delay(RETRY_DELAYS[error.code], attempt))
+
+
+def build_execute_code(calls: list) -> str:
+    """Собирает код VKScript, который вызывает несколько методов API за один запрос."""
+    return "return [{}];".format(",".join(
+        "API.{}({})".format(method, json.dumps(params, ensure_ascii=False))
+        for method, params in calls
+    ))
+
+
+async def execute_batch(vk, batch: list) -> list:
+    """
+    Один execute. Если ответ слишком большой (ошибка 13), пачка делится пополам
+    и повторяется; вызов, который не проходит и поодиночке, записывается в лог
+    и возвращается как false. Обрывы соединения и ошибки частоты повторяет vk.method,
+    остальные ошибки от размера пачки не зависят и пробрасываются
+    """
+    try:
+        return await vk.execute(code=build_execute_code(batch)) or [False] * len(batch)
+    except VkApiError as e:
+        if e.code != RESPONSE_TOO_LARGE:
+            raise
+        if len(batch) == 1:
+            logging.warning(f"Не удалось выполнить {batch[0][0]}: {e}")
+            metrics.inc("api_execute_failed_calls_total", method=batch[0][0])
+            return [False]
+        metrics.inc("api_execute_splits_total")
+        half = len(batch) // 2
+        return await execute_batch(vk, batch[:half]) + await execute_batch(vk, batch[half:])
+
+
+async def execute(vk, calls: list, batch_size=EXECUTE_LIMIT) -> list:
+    """
+    Выполняет вызовы пачками по batch_size (не больше EXECUTE_LIMIT) через метод execute.
+    Пачки отправляются одновременно. Для вызовов, завершившихся ошибкой, VK возвращает false
+    """
+    batch_size = max(1, min(batch_size, EXECUTE_LIMIT))
+    batches = [calls[i:i + batch_size] for i in range(0, len(calls), batch_size)]
+    responses = await asyncio.gather(*[execute_batch(vk, batch) for batch in batches])
+
+    results = []
+    for response in responses:
+        results.extend(response)
+    return results
+
+
+def take_until(items: list, stop) -> tuple:
+    """Элементы до первого, для которого stop(item) истинно, и встретился ли такой элемент"""
+    for i, item in enumerate(items):
+        if stop(item):
+            return items[:i], True
+    return items, False
+
+
+async def get_all_items(vk, sources: list, count=PAGE_SIZE, stop=None) -> tuple:
+    """
+    Собирает элементы всех страниц нескольких методов с параметрами count/offset.
+    Возвращает (элементы, число потерянных страниц): страницы, на которые VK ответил false,
+    пропускаются, и обход такого источника нельзя считать полным.
+    Первые страницы всех источников запрашиваются одним execute, а по полученному
+    count остальные страницы пакуются в execute так, чтобы в ответе было
+    не больше EXECUTE_ITEMS_LIMIT элементов.
+    Если передан stop, страницы каждого источника запрашиваются по порядку пачками,
+    и обход источника заканчивается на пачке, где встретился элемент, для которого
+    stop(item) истинно (при инкрементальной синхронизации — уже скачанное фото)
+    """
+    batch_size = max(1, min(EXECUTE_LIMIT, EXECUTE_ITEMS_LIMIT // count))
+    first_pages = await execute(vk, [
+        (method, dict(params, count=count, offset=0)) for method, params in sources
+    ], batch_size)
+
+    items = []
+    calls = []
+    ordered = []  # Страницы источников, которые обходятся по порядку до stop
+    for (method, params), page in zip(sources, first_pages):
+        # Например, закрытый альбом сохранённых фотографий
+        if not page:
+            continue
+
+        pages = [
+            (method, dict(params, count=count, offset=offset))
+            for offset in range(count, page["count"], count)
+        ]
+        if stop is None:
+            items.extend(page["items"])
+            calls.extend(pages)
+            continue
+
+        page_items, stopped = take_until(page["items"], stop)
+        items.extend(page_items)
+        if not stopped:
+            ordered.append(pages)
+
+    async def walk(pages: list) -> tuple:
+        walked = []
+        lost = 0
+        for i in range(0, len(pages), batch_size):
+            for page in await execute(vk, pages[i:i + batch_size], batch_size):
+                if not page:
+                    lost += 1
+                    continue
+                page_items, stopped = take_until(page["items"], stop)
+                walked.extend(page_items)
+                if stopped:
+                    return walked, lost
+        return walked, lost
+
+    lost = 0
+    for page in await execute(vk, calls, batch_size):
+        if page:
+            items.extend(page["items"])
+        else:
+            lost += 1
+    for walked, walk_lost in await asyncio.gather(*[walk(pages) for pages in ordered]):
+        items.extend(walked)
+        lost += walk_lost
+
+    return items, lost
+
+
+async def get_history_attachments(vk, peer_id: int, media_type="photo", start_from=None,
+                                  count=HISTORY_PAGE_SIZE):
+    """
+    Обходит все вложения переписки по курсору next_from, страница за страницей.
+    Отдаёт (курсор страницы, вложения страницы): с курсора страницы обход можно продолжить
+    """
+    while True:
+        params = {"peer_id": peer_id, "media_type": media_type, "count": count}
+        if start_from:
+            params["start_from"] = start_from
+        page = await vk.messages.getHistoryAttachments(**params)
+        if page["items"]:
+            yield start_from, page["items"]
+        start_from = page.get("next_from")
+        if not start_from or not page["items"]:
+            return
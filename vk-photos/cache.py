@@ -0,0 +1,103 @@
+import sys
+import json
+import time
+import sqlite3
+from collections import OrderedDict
+from pathlib import Path
+
+
+METADATA_CACHE_FILENAME = "metadata.sqlite3"
+METADATA_TTL = 24 * 60 * 60
+
+
+class MetadataCache:
+    """
+    Кэш ответов API о пользователях, группах и беседах.
+    В памяти хранится не больше max_size записей (вытесняются давно не использованные),
+    если передан db_path — записи сохраняются и на диск, чтобы пережить перезапуск.
+    Каждая запись живёт ttl секунд, после чего запрашивается заново
+    """
+
+    def __init__(self, db_path: Path = None, ttl=METADATA_TTL, max_size=10000):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.items = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+        self.db = None
+        if db_path is not None:
+            self.db = sqlite3.connect(db_path)
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS metadata ("
+                "key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL)"
+            )
+
+    def get(self, key: str):
+        now = time.time()
+        item = self.items.get(key)
+        if item is None and self.db is not None:
+            row = self.db.execute("SELECT value, expires_at FROM metadata WHERE key = ?", (key,)).fetchone()
+            if row is not None:
+                item = (json.loads(row[0]), row[1])
+                self.remember(key, item)
+
+        if item is None or item[1] <= now:
+            self.misses += 1
+            return None
+        self.items.move_to_end(key)
+        self.hits += 1
+        return item[0]
+
+    def set(self, key: str, value, ttl=None):
+        item = (value, time.time() + (self.ttl if ttl is None else ttl))
+        self.remember(key, item)
+        if self.db is not None:
+            self.db.execute(
+                "INSERT OR REPLACE INTO metadata VALUES (?, ?, ?)",
+                (key, json.dumps(value, ensure_ascii=False), item[1])
+            )
+
+    def remember(self, key: str, item: tuple):
+        self.items[key] = item
+        self.items.move_to_end(key)
+        while len(self.items) > self.max_size:
+            self.items.popitem(last=False)
+
+    async def get_or_fetch(self, key: str, fetch, ttl=None):
+        """Значение из кэша, а при промахе — результат await fetch(), который сразу кэшируется"""
+        value = self.get(key)
+        if value is None:
+            value = await fetch()
+            self.set(key, value, ttl)
+        return value
+
+    def invalidate(self, prefix=""):
+        """Удаляет записи, ключ которых начинается с prefix (по умолчанию все)"""
+        for key in [key for key in self.items if key.startswith(prefix)]:
+            del self.items[key]
+        if self.db is not None:
+            self.db.execute(
+                "DELETE FROM metadata WHERE substr(key, 1, ?) = ?", (len(prefix), prefix)
+            )
+            self.db.commit()
+
+    def report(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses}
+
+    def close(self):
+        if self.db is not None:
+            self.db.execute("DELETE FROM metadata WHERE expires_at <= ?", (time.time(),))
+            self.db.commit()
+            self.db.close()
+
+
+if __name__ == "__main__":
+    # python vk-photos/cache.py clear <папка загрузок> [префикс ключа, например group:1]
+    if len(sys.argv) not in (3, 4) or sys.argv[1] != "clear":
+        print("Использование: cache.py clear <папка загрузок> [префикс ключа]")
+        sys.exit(1)
+    cache = MetadataCache(Path(sys.argv[2]).joinpath(METADATA_CACHE_FILENAME))
+    cache.invalidate(sys.argv[3] if len(sys.argv) == 4 else "")
+    cache.close()
+    print("Кэш метаданных очищен")
@@ -1,72 +1,196 @@
 #!/usr/bin/env python
 # if running in py3, change the shebang, drop the next import for readability (it does no harm in py3)
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 import hashlib
+import os
+import sqlite3
+import time
 from pathlib import Path
 
-
-def chunk_reader(fobj, chunk_size=1024):
-    """Generator that reads a file in chunks of bytes"""
-    while True:
-        chunk = fobj.read(chunk_size)
-        if not chunk:
-            return
-        yield chunk
-
-
-def get_hash(filename: Path, first_chunk_only=False, hash=hashlib.sha1):
+from metrics import metrics
+
+
+class DigestIndex:
+    """Digests of the photos already downloaded into a folder, used to drop duplicates while downloading"""
+
+    def __init__(self, digests=()):
+        self.digests = set(digests)
+        self.duplicates = 0
+
+    def add(self, digest) -> bool:
+        """Adds a digest, returns False if it has been seen before"""
+        if digest in self.digests:
+            self.duplicates += 1
+            return False
+        self.digests.add(digest)
+        return True
+
+
+class SeenPhotos:
+    """
+    Photo records already queued in this run, keyed by (owner_id, id) and by URL,
+    so a photo listed twice (reposts, overlapping albums) is requested only once.
+    Keys are packed into ints to keep the sets small on long walls
+    """
+
+    def __init__(self):
+        self.ids = set()
+        self.urls = set()
+        self.skipped = 0
+
+    @staticmethod
+    def get_id_key(photo: dict) -> int:
+        # Photo ids fit into 33 bits, owner_id takes the rest (and keeps its sign)
+        return (photo["owner_id"] << 33) + photo["id"]
+
+    @staticmethod
+    def get_url_key(url: str) -> int:
+        return int.from_bytes(hashlib.blake2b(url.encode(), digest_size=8).digest(), "big")
+
+    def add(self, photo: dict) -> bool:
+        """Adds a photo record, returns False if it or its URL has been seen before"""
+        id_key = self.get_id_key(photo)
+        url_key = self.get_url_key(photo["url"]) if photo.get("url") else None
+        if id_key in self.ids or url_key in self.urls:
+            self.skipped += 1
+            return False
+        self.ids.add(id_key)
+        if url_key is not None:
+            self.urls.add(url_key)
+        return True
+
+
+MEDIA_EXTENSIONS = {".jpg", ".jpeg", ".png", ".gif", ".webp", ".mp4", ".webm", ".mov"}
+HASH_CACHE_FILENAME = "hashes.sqlite3"
+CHUNK_SIZE = 1024 * 1024
+HASH_BATCH = 256  # Small files are hashed in batches to keep pool overhead low
+
+
+class HashCache:
+    """
+    Persistent file digests keyed by (device, inode, size, mtime):
+    a file that has not changed since the last scan is never read again
+    """
+
+    def __init__(self, db_path: Path):
+        self.db = sqlite3.connect(db_path)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS hashes ("
+            "dev INTEGER, ino INTEGER, size INTEGER, mtime INTEGER, hash TEXT, "
+            "PRIMARY KEY (dev, ino, size, mtime))"
+        )
+        self.hashes = {
+            tuple(row[:4]): row[4] for row in self.db.execute("SELECT * FROM hashes")
+        }
+        self.new_hashes = {}
+
+    @staticmethod
+    def get_key(stat: os.stat_result) -> tuple:
+        return stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns
+
+    def get(self, key: tuple):
+        return self.hashes.get(key)
+
+    def set(self, key: tuple, digest: str):
+        self.hashes[key] = digest
+        self.new_hashes[key] = digest
+
+    def save(self):
+        self.db.executemany(
+            "INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, ?)",
+            [(*key, digest) for key, digest in self.new_hashes.items()]
+        )
+        self.db.commit()
+        self.new_hashes = {}
+
+    def close(self):
+        self.save()
+        self.db.close()
+
+
+def new_hash():
+    """The digest used everywhere: while downloading, in the sync manifest and by the scanner"""
+    return hashlib.blake2b(digest_size=20)
+
+
+def get_hash(filename: Path, hash=new_hash) -> str:
+    """Hashes a file with large reads, hashlib releases the GIL so this scales in threads"""
     hashobj = hash()
-    with open(filename, "rb") as file_object:
-        if first_chunk_only:
-            hashobj.update(file_object.read(1024))
-        else:
-            for chunk in chunk_reader(file_object):
-                hashobj.update(chunk)
-        hashed = hashobj.digest()
-
-        return hashed
-
-
-def check_for_duplicates(path: Path) -> int:
-    hashes_by_size = defaultdict(list)  # dict of size_in_bytes: [full_path_to_file1, full_path_to_file2, ]
-    hashes_on_1k = defaultdict(list)  # dict of (hash1k, size_in_bytes): [full_path_to_file1, full_path_to_file2, ]
-    hashes_full = {}   # dict of full_file_hash: full_path_to_file_string
-    files = path.glob("*.jpg")
-
-    for file_path in files:
-        # if the target is a symlink (soft one), this will
-        # dereference it - change the value to the actual target file
-        file_size = file_path.stat().st_size
-        hashes_by_size[file_size].append(file_path)
-
-
-    # For all files with the same file size, get their hash on the 1st 1024 bytes only
-    for size_in_bytes, files in hashes_by_size.items():
-        if len(files) < 2:
-            continue    # this file size is unique, no need to spend CPU cycles on it
-
-        for filename in files:
-            small_hash = get_hash(filename, first_chunk_only=True)
-            # the key is the hash on the first 1024 bytes plus the size - to
-            # avoid collisions on equal hashes in the first part of the file
-            hashes_on_1k[(small_hash, size_in_bytes)].append(filename)
-
+    with open(filename, "rb", buffering=0) as file_object:
+        while True:
+            chunk = file_object.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            hashobj.update(chunk)
+    return hashobj.hexdigest()
+
+
+def hash_files(filenames: list) -> list:
+    return [get_hash(filename) for filename in filenames]
+
+
+def scan_media(path, recursive=False):
+    """Yields (path, stat) of media files; os.scandir gives the stat without extra syscalls"""
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                if recursive:
+                    yield from scan_media(entry.path, recursive)
+            elif entry.is_file() and os.path.splitext(entry.name)[1].lower() in MEDIA_EXTENSIONS:
+                yield entry.path, entry.stat()
+
+
+def check_for_duplicates(path: Path, recursive=False, cache: HashCache = None,
+                         workers=None, delete=True) -> int:
+    """
+    Finds files with identical content among the media files in path and
+    deletes all but the first one (in path order). Only files sharing a size
+    are hashed, in batches on a thread pool; digests come from cache when the file is unchanged.
+    Returns the number of duplicates
+    """
+    time_start = time.monotonic()
+    own_cache = cache is None
+    if own_cache:
+        cache = HashCache(path.joinpath(HASH_CACHE_FILENAME))
+
+    files_by_size = defaultdict(list)  # dict of size_in_bytes: [(path, stat), ...]
+    for file_path, stat in sorted(scan_media(path, recursive)):
+        files_by_size[stat.st_size].append((file_path, stat))
+
+    # this file size is unique, no need to spend IO on it
+    candidates = [
+        (file_path, HashCache.get_key(stat))
+        for files in files_by_size.values() if len(files) > 1
+        for file_path, stat in files
+    ]
+    to_hash = [(file_path, key) for file_path, key in candidates if cache.get(key) is None]
+
+    batches = [to_hash[i:i + HASH_BATCH] for i in range(0, len(to_hash), HASH_BATCH)]
+    with ThreadPoolExecutor(max_workers=workers or min(32, (os.cpu_count() or 1) * 4)) as executor:
+        for batch, digests in zip(batches, executor.map(hash_files, [[f for f, _ in b] for b in batches])):
+            for (file_path, key), digest in zip(batch, digests):
+                cache.set(key, digest)
+
+    hashes_full = {}  # dict of full_file_hash: first path with this content
     duplicates = []
+    for file_path, key in candidates:
+        digest = cache.get(key)
+        if digest in hashes_full:
+            duplicates.append(file_path)
+        else:
+            hashes_full[digest] = file_path
 
-    # For all files with the hash on the 1st 1024 bytes, get their hash on the full file - collisions will be duplicates
-    for __, files_list in hashes_on_1k.items():
-        if len(files_list) < 2:
-            continue    # this hash of fist 1k file bytes is unique, no need to spend cpy cycles on it
-
-        for filename in files_list:
-            full_hash = get_hash(filename, first_chunk_only=False)
-            duplicate = hashes_full.get(full_hash)
-            if duplicate:
-                duplicates.append(filename)
-            else:
-                hashes_full[full_hash] = filename
+    if own_cache:
+        cache.close()
+    else:
+        cache.save()
 
-    for file in duplicates:
-        file.unlink()
+    if delete:
+        for file in duplicates:
+            os.unlink(file)
 
-    return len(duplicates)
\ No newline at end of file
+    metrics.inc("dedup_files_hashed_total", len(to_hash))
+    metrics.inc("dedup_duplicates_total", len(duplicates))
+    metrics.observe("dedup_seconds", time.monotonic() - time_start)
+    return len(duplicates)
@@ -1,18 +1,55 @@
+import os
 import json
+import time
+import random
+import logging
+from collections import Counter
+from functools import lru_cache
 from pathlib import Path
+from urllib.parse import urlsplit
 
 import aiohttp
 import aiofiles
 import asyncio
-from tqdm.asyncio import tqdm
-from pytrovich.enums import NamePart, Gender, Case
-from pytrovich.maker import PetrovichDeclinationMaker
-import yt_dlp
+from concurrent.futures import Executor
 
-maker = PetrovichDeclinationMaker()
+from filter import DigestIndex, SeenPhotos, new_hash
+from metrics import metrics
+from sizes import record_savings
+from transport import transport
+from scheduler import AdaptiveLimiter
+from state import SyncState
+from storage import ContentStore
+
+CHUNK_SIZE = 64 * 1024
+QUEUE_SIZE = 1000  # Сколько найденных фото может ждать загрузки
+
+CORRUPT = -1  # Код «ответа» для скачанного, но битого файла
+WRITE_ERROR = -2  # Код «ответа» для скачанного файла, который не удалось сохранить
+MAX_ATTEMPTS = 4
+# Базовая пауза перед повтором для каждого класса ошибок
+RETRY_DELAYS = {
+    "network": 1.0,
+    "server": 2.0,
+    "throttled": 5.0,
+    "corrupt": 0.5,
+    "disk": 1.0
+}
+
+VIDEO_WORKERS = 2  # Сколько видео качается одновременно (по процессу на видео)
+VIDEO_FRAGMENTS = 4  # Сколько фрагментов одного видео качается одновременно
+VIDEO_ATTEMPTS = 3
+
+@lru_cache(maxsize=None)
+def get_maker():
+    """Словари склонений читаются при первом обращении, а не при запуске"""
+    from pytrovich.maker import PetrovichDeclinationMaker
+    return PetrovichDeclinationMaker()
 
 def decline(first_name, last_name, sex):
     """Возвращает имя и фамилию в родительном падаже."""
+    from pytrovich.enums import NamePart, Gender, Case
+    maker = get_maker()
     if sex == 1:
         first_name = maker.make(NamePart.FIRSTNAME, Gender.FEMALE, Case.GENITIVE, first_name)
         last_name = maker.make(NamePart.LASTNAME, Gender.FEMALE, Case.GENITIVE, last_name)
@@ -25,40 +62,354 @@ def write_json(data, title="data"):
     with open(title + ".json", "w", encoding="utf-8") as file:
         json.dump(data, file, indent=2, ensure_ascii=False)
 
-async def download_photo(session: aiohttp.ClientSession, photo_url: str, photo_path: Path):
+def get_failure(status):
+    """Класс ошибки загрузки, после которой стоит повторить попытку (None — повторять бессмысленно)"""
+    if status is None:
+        return "network"
+    if status in (CORRUPT, 416):
+        return "corrupt"
+    if status == WRITE_ERROR:
+        return "disk"
+    if status in (429, 503):
+        return "throttled"
+    if status >= 500:
+        return "server"
+    return None
+
+def is_complete_image(file_path: Path) -> bool:
+    """JPEG должен заканчиваться маркером конца изображения FF D9"""
+    with open(file_path, "rb") as f:
+        if f.read(2) != b"\xff\xd8":
+            return True
+        f.seek(max(0, file_path.stat().st_size - 32))
+        return f.read().rstrip(b"\x00").endswith(b"\xff\xd9")
+
+async def download_photo(session: aiohttp.ClientSession, photo_url: str, photo_path: Path,
+                         index: DigestIndex = None, store: ContentStore = None):
+    """
+    Скачивает фото и возвращает код ответа, размер и хеш файла.
+    Код None означает обрыв соединения, CORRUPT — битый файл.
+    Фото пишется кусками во временный .part файл и переименовывается только
+    после полной загрузки, поэтому прерванная загрузка не оставляет битых .jpg.
+    После обрыва .part файл остаётся, и следующая попытка докачивает его через Range.
+    Размер сверяется с Content-Length, у JPEG проверяется маркер конца изображения.
+    Хеш считается по ходу загрузки: если такое фото уже есть в index,
+    .part файл удаляется и дубликат не попадает в папку.
+    Если передан store, файл переносится в хранилище, а в папке создаётся ссылка на него
+    """
+    part_path = photo_path.with_name(photo_path.name + ".part")
+    size = part_path.stat().st_size if part_path.exists() else 0
+    headers = {"Range": f"bytes={size}-"} if size else {}
+    hashobj = new_hash()
     try:
-        if not photo_path.exists():
-            async with session.get(photo_url) as response:
-                if response.status == 200:
-                    async with aiofiles.open(photo_path, "wb") as f:
-                        await f.write(await response.read())
+        async with session.get(photo_url, headers=headers) as response:
+            if response.status == 416:
+                part_path.unlink()
+                return response.status, 0, None
+            if response.status not in (200, 206):
+                return response.status, 0, None
+
+            if response.status == 206:
+                # Докачка: хеш считается и по уже скачанной части
+                with open(part_path, "rb") as f:
+                    for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+                        hashobj.update(chunk)
+                total = response.headers.get("Content-Range", "").rpartition("/")[2]
+                expected = int(total) if total.isdigit() else None
+                mode = "ab"
+            else:
+                size = 0
+                expected = response.content_length
+                mode = "wb"
+
+            async with aiofiles.open(part_path, mode) as f:
+                async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+                    size += len(chunk)
+                    hashobj.update(chunk)
+                    await f.write(chunk)
     except Exception as e:
         print(e)
+        return None, 0, None
+
+    if expected is not None and size != expected:
+        return None, size, None
+
+    digest = hashobj.hexdigest()
+    added = False
+    try:
+        if not is_complete_image(part_path):
+            part_path.unlink()
+            return CORRUPT, size, None
+
+        added = index is None or index.add(digest)
+        if not added:
+            metrics.inc("duplicates_skipped_total")
+            part_path.unlink()
+        elif store is not None:
+            store.add(part_path, digest)
+            store.link(digest, photo_path)
+        else:
+            os.replace(part_path, photo_path)
+    except OSError as e:
+        # Файл не сохранён, поэтому при повторе он не должен считаться дубликатом
+        if added and index is not None:
+            index.digests.discard(digest)
+        logging.info(f"Не удалось сохранить {photo_path.name}: {e}")
+        return WRITE_ERROR, size, None
+    return 200, size, digest
+
+async def download_with_retries(session: aiohttp.ClientSession, photo: dict, photo_path: Path,
+                                limiter: AdaptiveLimiter, index: DigestIndex,
+                                state: SyncState = None, store: ContentStore = None):
+    """
+    Повторяет загрузку после обрыва, ошибки сервера, 429 или битого файла
+    с экспоненциальной паузой (своей для каждого класса ошибок).
+    Фото, которое так и не удалось скачать, записывается в журнал ошибок.
+    Возвращает, удалось ли скачать фото
+    """
+    host = urlsplit(photo["url"]).hostname
+    # Слоты загрузки честно делятся между папками, которые качаются одновременно
+    owner = photo_path.parent
+    for attempt in range(MAX_ATTEMPTS):
+        await limiter.acquire(host, owner)
+        time_start = time.monotonic()
+        status = None
+        try:
+            status, size, digest = await download_photo(session, photo["url"], photo_path, index, store)
+        finally:
+            await limiter.release(host, time.monotonic() - time_start, status, owner)
+
+        if status == 200:
+            elapsed = time.monotonic() - time_start
+            metrics.inc("photos_downloaded_total")
+            metrics.inc("bytes_downloaded_total", size)
+            metrics.observe("download_latency_seconds", elapsed)
+            record_savings(photo, size, elapsed)
+            if state:
+                state.add_photo(photo_path.parent, photo, size, digest)
+                state.remove_failed(photo_path.parent, photo)
+            return True
+
+        failure = get_failure(status)
+        metrics.inc("download_errors_total", **{"class": failure or str(status)})
+        if failure is None or attempt == MAX_ATTEMPTS - 1:
+            break
+        await asyncio.sleep(RETRY_DELAYS[failure] * 2 ** attempt * random.uniform(0.5, 1.5))
+
+    metrics.inc("photos_failed_total")
+    if state:
+        state.add_failed(photo_path.parent, photo, failure or str(status))
+    return False
+
+async def download_worker(session: aiohttp.ClientSession, queue: asyncio.Queue,
+                          limiter: AdaptiveLimiter, progress, index: DigestIndex,
+                          state: SyncState = None, store: ContentStore = None, stats: Counter = None):
+    while True:
+        photo, photo_path = await queue.get()
+        metrics.set("download_queue_depth", queue.qsize())
+        try:
+            synced = state and state.has_photo(photo_path.parent, photo["owner_id"], photo["id"])
+            if synced or photo_path.exists():
+                metrics.inc("photos_already_synced_total")
+                continue
+
+            # Фото уже скачано для другой папки: достаточно ссылки на файл из хранилища
+            stored = store and state and state.find_hash(photo["owner_id"], photo["id"])
+            if stored and store.has(stored[0]):
+                digest, size = stored
+                if index.add(digest):
+                    store.link(digest, photo_path)
+                state.add_photo(photo_path.parent, photo, size, digest)
+                metrics.inc("photos_linked_total")
+            elif not await download_with_retries(session, photo, photo_path, limiter, index, state, store):
+                stats["failed"] += 1
+        except Exception as e:
+            # Ошибка одного фото не должна останавливать воркер, иначе queue.join() не дождётся очереди
+            logging.info(f"Не удалось скачать {photo_path.name}: {e!r}")
+            metrics.inc("photos_failed_total")
+            stats["failed"] += 1
+            if state:
+                state.add_failed(photo_path.parent, photo, type(e).__name__)
+        finally:
+            progress.update()
+            queue.task_done()
+
+def has_dates(dates) -> bool:
+    """Задан ли хотя бы один конец промежутка (с, по)"""
+    return bool(dates) and any(date is not None for date in dates)
 
-async def download_photos(photos_path: Path, photos: list):
-    async with aiohttp.ClientSession() as session:
-        futures = []
-        for i, photo in enumerate(photos, start=1):
-            photo_title = "{}_{}.jpg".format(photo["owner_id"], photo["id"])
-            photo_path = photos_path.joinpath(photo_title)
-            futures.append(download_photo(session, photo["url"], photo_path))
-
-        for future in tqdm(asyncio.as_completed(futures), total=len(futures)):
-            await future
-
-async def download_video(video_path, video_link):
-    ydl_opts = {'outtmpl': '{}'.format(video_path), 'quiet': True, 'retries': 10}
-    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-        ydl.download(video_link)
-        print("Видео загружено: {}".format(video_link))
-
-async def download_videos(videos_path: Path, videos: list):
-    futures = []
-    for i, video in enumerate(videos, start=1):
-        filename = "{}_{}.mp4".format(video["owner_id"], video["id"])#, video["title"])
+def in_dates(photo: dict, dates: tuple) -> bool:
+    """Фото без даты (например, аватарка закрытого профиля) скачиваются всегда"""
+    since, until = dates
+    date = photo.get("date")
+    if date is None:
+        return True
+    return (since is None or date >= since) and (until is None or date < until)
+
+async def iterate_photos(photos):
+    """Позволяет обходить одинаково и список фото, и асинхронный генератор."""
+    if hasattr(photos, "__aiter__"):
+        async for photo in photos:
+            yield photo
+    else:
+        for photo in photos:
+            yield photo
+
+async def merge_photos(*sources):
+    """Обходит несколько асинхронных генераторов фото одновременно и отдаёт фото по мере появления"""
+    queue = asyncio.Queue(maxsize=QUEUE_SIZE)
+    finished = object()
+
+    async def drain(source):
+        try:
+            async for photo in source:
+                await queue.put(photo)
+        finally:
+            await queue.put(finished)
+
+    tasks = [asyncio.create_task(drain(source)) for source in sources]
+    try:
+        remaining = len(tasks)
+        while remaining:
+            photo = await queue.get()
+            if photo is finished:
+                remaining -= 1
+            else:
+                yield photo
+        # Пробрасываем ошибку, если какой-то из обходов упал
+        await asyncio.gather(*tasks)
+    finally:
+        for task in tasks:
+            task.cancel()
+
+async def download_photos(photos_path: Path, photos, limiter: AdaptiveLimiter = None,
+                          state: SyncState = None, store: ContentStore = None, dates=None):
+    """
+    Скачивает фотографии пулом из limiter.max_limit воркеров,
+    реально одновременно идёт не больше limiter.limit загрузок.
+    photos может быть асинхронным генератором: тогда загрузка начинается сразу,
+    а ограниченная очередь приостанавливает генератор, если загрузка не успевает.
+    Если передан state, скачанные фото записываются в манифест,
+    а уже записанные в нём пропускаются без обращения к диску.
+    Если передан store, фото хранятся в нём, а в photos_path создаются ссылки.
+    Повторы одного фото (тот же owner_id и id или тот же url) отбрасываются до загрузки.
+    dates — (с, по) в unix time: фото с датой вне этого промежутка не скачиваются.
+    Возвращает количество скачанных фото (без неудачных) и количество отброшенных дубликатов
+    """
+    from tqdm.asyncio import tqdm
+
+    limiter = limiter or AdaptiveLimiter()
+    index = DigestIndex(state.get_hashes(photos_path) if state else ())
+    seen = SeenPhotos()
+    queue = asyncio.Queue(maxsize=QUEUE_SIZE)
+    stats = Counter()
+    photos_count = 0
+
+    # Сессия общая для всех источников, поэтому соединения с серверами фото остаются открытыми
+    session = transport.get_session()
+    with tqdm(total=len(photos) if isinstance(photos, list) else None) as progress:
+        workers = [
+            asyncio.create_task(download_worker(session, queue, limiter, progress, index, state, store, stats))
+            for _ in range(limiter.max_limit)
+        ]
+        try:
+            # Время ожидания следующего фото от генератора — это время обхода источника через API
+            waited = time.monotonic()
+            async for photo in iterate_photos(photos):
+                metrics.inc("enumeration_seconds_total", time.monotonic() - waited)
+                if dates and not in_dates(photo, dates):
+                    waited = time.monotonic()
+                    continue
+                # Одно и то же фото (репосты, пересекающиеся альбомы) ставится в очередь один раз,
+                # иначе две загрузки одного файла идут одновременно и перезаписывают друг друга
+                if not seen.add(photo):
+                    metrics.inc("photos_deduplicated_total")
+                    if progress.total:
+                        progress.total -= 1
+                    waited = time.monotonic()
+                    continue
+                photo_title = "{}_{}.jpg".format(photo["owner_id"], photo["id"])
+                await queue.put((photo, photos_path.joinpath(photo_title)))
+                metrics.set("download_queue_depth", queue.qsize())
+                metrics.inc("photos_found_total")
+                photos_count += 1
+                waited = time.monotonic()
+            metrics.inc("enumeration_seconds_total", time.monotonic() - waited)
+            await queue.join()
+        finally:
+            for worker in workers:
+                worker.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+            if state:
+                state.commit()
+
+    logging.info("Параллельных загрузок: {limit} (максимум {peak_limit}), ошибок: {errors}, "
+                 "ответов 429/503: {throttled}".format(**limiter.report()))
+    if seen.skipped:
+        logging.info(f"Повторяющихся фото пропущено до загрузки: {seen.skipped} (столько же запросов сэкономлено)")
+    if stats["failed"]:
+        logging.info(f"Не удалось скачать {stats['failed']} фото")
+    return photos_count - stats["failed"], index.duplicates
+
+def download_video(video_path: Path, video_link: str, fragments=VIDEO_FRAGMENTS) -> int:
+    """Скачивает одно видео; запускается в отдельном процессе, чтобы не блокировать цикл событий"""
+    import yt_dlp
+
+    ydl_opts = {
+        "outtmpl": str(video_path),
+        "quiet": True,
+        "noprogress": True,
+        "retries": 10,
+        "fragment_retries": 10,
+        # HLS/DASH видео качаются несколькими фрагментами одновременно
+        "concurrent_fragment_downloads": fragments
+    }
+    try:
+        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+            return ydl.download([video_link])
+    except Exception as e:
+        # Исключения yt-dlp не всегда можно передать из процесса пула
+        raise RuntimeError(str(e)) from None
+
+async def download_video_with_retries(executor: Executor, video_path: Path, video_link: str,
+                                      fragments: int, progress):
+    loop = asyncio.get_running_loop()
+    try:
+        for attempt in range(VIDEO_ATTEMPTS):
+            try:
+                await loop.run_in_executor(executor, download_video, video_path, video_link, fragments)
+                progress.write("Видео загружено: {}".format(video_link))
+                return True
+            except Exception as e:
+                progress.write("Не удалось скачать видео {} (попытка {}): {}".format(video_link, attempt + 1, e))
+                if attempt < VIDEO_ATTEMPTS - 1:
+                    await asyncio.sleep(RETRY_DELAYS["server"] * 2 ** attempt * random.uniform(0.5, 1.5))
+        return False
+    finally:
+        progress.update()
+
+async def download_videos(videos_path: Path, videos: list, workers=VIDEO_WORKERS, fragments=VIDEO_FRAGMENTS):
+    """
+    Скачивает видео пулом из workers процессов, не блокируя загрузку фото.
+    Уже скачанные видео пропускаются, недокачанные yt-dlp продолжает с места обрыва.
+    Возвращает количество видео, которые так и не удалось скачать
+    """
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+    from tqdm.asyncio import tqdm
+
+    jobs = []
+    for video in videos:
+        filename = "{}_{}.mp4".format(video["owner_id"], video["id"])
         video_path = videos_path.joinpath(filename)
-        futures.append(download_video(video_path, video["player"]))
-    print(len(futures))
-    for future in tqdm(asyncio.as_completed(futures), total=len(futures)):
-        await future
-            
\ No newline at end of file
+        if not video_path.exists():
+            jobs.append((video_path, video["player"]))
+
+    # spawn, а не fork: в родительском процессе уже работают потоки aiofiles и aiohttp
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+        with tqdm(total=len(jobs), desc="Видео") as progress:
+            results = await asyncio.gather(*[
+                download_video_with_retries(executor, video_path, video_link, fragments, progress)
+                for video_path, video_link in jobs
+            ])
+    return results.count(False)
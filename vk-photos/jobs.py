@@ -0,0 +1,123 @@
+import json
+import time
+import asyncio
+import logging
+from datetime import date, datetime, timedelta
+from pathlib import Path
+
+from sizes import SizePolicy
+
+
+# Типы источников в файле заданий
+JOB_SOURCES = {"user", "users", "group", "groups", "chat", "chat_members", "dialog"}
+
+
+class JobError(Exception):
+    pass
+
+
+class JobFailed(JobError):
+    """Задание выполнено не полностью: photos фото скачано, но часть источников не удалась"""
+
+    def __init__(self, message: str, photos=0):
+        super().__init__(message)
+        self.photos = photos
+
+
+def parse_date(value: str, end=False):
+    """'2024-01-31' -> unix time начала дня (или начала следующего дня, если end)"""
+    if value is None:
+        return None
+    day = date.fromisoformat(value)
+    if end:
+        day += timedelta(days=1)
+    return int(datetime(day.year, day.month, day.day).timestamp())
+
+
+def parse_job(line: str, number: int) -> dict:
+    """
+    Строка файла заданий, например:
+    {"source": "group", "id": 93933459, "videos": true, "priority": 10, "since": "2024-01-01"}
+    Для users и groups вместо id указывается список ids,
+    size ("max", "long_edge:1280", "type:x") задаёт размер фото вместо photo_size из config.yaml
+    """
+    try:
+        job = json.loads(line)
+        if job.get("source") not in JOB_SOURCES:
+            raise JobError(f"неизвестный источник {job.get('source')!r}")
+        if job["source"] in ("users", "groups"):
+            ids = [int(id) for id in job["ids"]]
+        else:
+            ids = [int(job["id"])]
+        return {
+            "number": number,
+            "source": job["source"],
+            "ids": ids,
+            "videos": bool(job.get("videos", False)),
+            "priority": int(job.get("priority", 0)),
+            "dates": (parse_date(job.get("since")), parse_date(job.get("until"), end=True)),
+            "size_policy": SizePolicy.parse(job["size"]) if "size" in job else None
+        }
+    except (ValueError, KeyError, TypeError) as e:
+        raise JobError(f"строка {number}: {e}") from None
+    except JobError as e:
+        raise JobError(f"строка {number}: {e}") from None
+
+
+def load_jobs(path: Path) -> list:
+    with open(path, encoding="utf-8") as file:
+        return [
+            parse_job(line, number)
+            for number, line in enumerate(file, start=1)
+            if line.strip() and not line.lstrip().startswith("#")
+        ]
+
+
+def describe(job: dict) -> str:
+    return "{} {}".format(job["source"], ",".join(map(str, job["ids"])))
+
+
+async def run_jobs(jobs: list, run_job, concurrency=2) -> list:
+    """
+    Выполняет задания очередью с приоритетом: задания с большим priority
+    начинаются раньше, при равном — в порядке файла. Одновременно выполняется
+    не больше concurrency заданий. Ошибка в задании не останавливает остальные.
+    Возвращает итог по каждому заданию
+    """
+    queue = asyncio.PriorityQueue()
+    for job in jobs:
+        queue.put_nowait((-job["priority"], job["number"], job))
+    results = []
+
+    async def worker():
+        while not queue.empty():
+            _, _, job = queue.get_nowait()
+            time_start = time.time()
+            logging.info(f"Задание {job['number']}: {describe(job)}")
+            result = {"job": job, "status": "ok", "photos": 0, "error": None}
+            try:
+                result["photos"] = await run_job(job) or 0
+            except JobFailed as e:
+                logging.info(f"Задание {job['number']} выполнено не полностью: {e}")
+                result.update(status="failed", error=str(e), photos=e.photos)
+            except Exception as e:
+                logging.exception(f"Задание {job['number']} завершилось ошибкой")
+                result.update(status="failed", error=str(e))
+            result["time"] = time.time() - time_start
+            results.append(result)
+
+    await asyncio.gather(*[worker() for _ in range(max(1, min(concurrency, len(jobs))))])
+    results.sort(key=lambda result: result["job"]["number"])
+    return results
+
+
+def log_summary(results: list):
+    logging.info("Итоги заданий:")
+    for result in results:
+        job = result["job"]
+        line = "{:>4}. {:<40} {:<6} фото: {:<6} {:.0f} с".format(
+            job["number"], describe(job)[:40], result["status"], result["photos"], result["time"]
+        )
+        if result["error"]:
+            line += f" ({result['error']})"
+        logging.info(line)
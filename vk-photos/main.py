@@ -1,27 +1,41 @@
 #import os
-#import sys
+import sys
 import math
+import argparse
 import time
 import logging
+from collections import deque
 from pathlib import Path
 # from PIL import Image, ImageChops
 
 import yaml
-import requests
 #import aiohttp
 #import aiofiles
 import asyncio
-import vk_api
 #import tqdm
 from pytils import numeral
 
-from filter import check_for_duplicates
+from api import AsyncVkApi, get_all_items, get_history_attachments
+from filter import HASH_CACHE_FILENAME, HashCache, check_for_duplicates
+from scheduler import AdaptiveLimiter
+from state import SyncState
+from storage import STORE_DIRNAME, ContentStore
+from profiles import ProfileResolver
+from cache import METADATA_CACHE_FILENAME, MetadataCache
+from jobs import JobError, JobFailed, load_jobs, log_summary, run_jobs
+from metrics import metrics
+from sizes import SizePolicy, log_savings
+from transport import transport
 from functions import (
+    QUEUE_SIZE,
     decline,
+    download_photo,
     download_photos,
-    download_videos
+    download_videos,
+    has_dates,
+    in_dates,
+    merge_photos
 )
-import yt_dlp
 
 BASE_DIR = Path(__file__).resolve().parent
 DOWNLOADS_DIR = Path('D:\ghd').resolve().joinpath("Фотки")#BASE_DIR.joinpath("Фотки")
@@ -29,7 +43,8 @@ CONFIG_PATH = BASE_DIR.joinpath("config.yaml")
 VK_CONFIG_PATH = BASE_DIR.joinpath("vk_config.v2.json")
 
 with open(CONFIG_PATH, encoding="utf-8") as ymlFile:
-    config = yaml.load(ymlFile.read(), Loader=yaml.Loader)
+    # C-загрузчик (если PyYAML собран с libyaml) разбирает конфиг в разы быстрее
+    config = yaml.load(ymlFile.read(), Loader=getattr(yaml, "CSafeLoader", yaml.SafeLoader))
 
 logging.basicConfig(
     format='%(asctime)s - %(message)s',
@@ -40,6 +55,23 @@ logging.basicConfig(
 logger = logging.getLogger('vk_api')
 logger.disabled = True
 
+# Общий на все загрузки лимит, подобранный лимит сохраняется между источниками
+limiter = AdaptiveLimiter(
+    max_limit=config.get("max_concurrency", 64),
+    per_host=config.get("per_host_concurrency", 16)
+)
+
+# Одна HTTP-сессия на все запросы к API и загрузки
+transport.configure(
+    connections=config.get("http_connections", 100),
+    connections_per_host=config.get("http_connections_per_host", 32),
+    keepalive=config.get("http_keepalive", 60),
+    dns_ttl=config.get("http_dns_ttl", 300)
+)
+
+# Какой размер фото скачивать, если источник не задаёт свой
+default_size_policy = SizePolicy.parse(config.get("photo_size"))
+
 loop = asyncio.get_event_loop()
 
 
@@ -53,6 +85,9 @@ class Utils:
             dir_path.rmdir()
 
     def auth(self):
+        # vk_api нужен только для входа по логину и паролю
+        import vk_api
+
         try:
             vk_session = vk_api.VkApi(
                 login=config["login"],
@@ -67,12 +102,13 @@ class Utils:
             exit()
         finally:
             logging.info('Вы успешно авторизовались.')
-            return vk_session.get_api()
+            return AsyncVkApi(vk_session.token["access_token"], rate=config.get("api_rate", 3))
 
     def auth_by_token(self):
         try:
-            vk_session = vk_api.VkApi(
-                token=config["token"]
+            vk_session = AsyncVkApi(
+                token=config["token"],
+                rate=config.get("api_rate", 3)
             )
         except Exception as e:
             logging.info("Неправильный токен")
@@ -80,194 +116,171 @@ class Utils:
             exit()
         finally:
             logging.info('Вы успешно авторизовались.')
-            return vk_session.get_api()
+            if vk_session.tokens_count > 1:
+                logging.info(f"Запросы распределяются между {vk_session.tokens_count} токенами")
+            return vk_session
 
-    def check_user_id(self, id: str) -> bool:
+    async def check_user_id(self, id: str) -> bool:
         try:
             # Проверяем, существует ли пользователь с таким id
-            user = vk.users.get(user_ids=int(id))
-            if len(user) != 0: return True
-            return False
+            return await self.get_profile(id) is not None
         except:
             return False
 
-    def check_user_ids(self, ids_list) -> bool:
+    async def check_user_ids(self, ids_list) -> bool:
         try:
-            for user_id in ids_list.split(","):
-                if not self.check_user_id(user_id):
-                    return False
-            return True
+            # Все id проверяются одним запросом
+            user_ids = {int(user_id) for user_id in ids_list.split(",")}
+            return len(await self.get_profiles(user_ids)) == len(user_ids)
         except:
             return False
 
-    def check_group_id(self, id: str) -> bool:
+    async def check_group_id(self, id: str) -> bool:
         try:
             # Проверяем, существует ли группа с таким id
-            group = vk.groups.getById(group_id=int(id))
-            if len(group) != 0: return True
-            return False
+            return await self.get_group(int(id)) is not None
         except Exception as e:
             print(e)
             return False
 
-    def check_group_ids(self, ids_list) -> bool:
+    async def check_group_ids(self, ids_list) -> bool:
         try:
             for group_id in ids_list.split(","):
-                if not self.check_group_id(group_id):
+                if not await self.check_group_id(group_id):
                     return False
             return True
         except:
             return False
 
-    def check_chat_id(self, id: str) -> bool:
+    async def check_chat_id(self, id: str) -> bool:
         try:
             # Проверяем, существует ли беседа с таким id
-            conversation = vk.messages.getConversationsById(peer_ids=2000000000 + int(id))
+            conversation = await self.get_conversation(int(id))
             if conversation["count"] != 0: return True
             return False
         except:
             return False
 
-    def get_user_id(self):
-        return vk.account.getProfileInfo()["id"]
-
-    def get_username(self, user_id: str):
-        user = vk.users.get(user_id=user_id)[0]
-        return f"{user['first_name']} {user['last_name']}"
-
-    def get_group_title(self, group_id: str):
-        group_info = vk.groups.getById(group_id=group_id)
-        group_name = group_info[0]["name"].replace("/", " ").replace("|", " ").replace(".", " ").strip()
-        return group_name
+    async def get_user_id(self):
+        return (await vk.account.getProfileInfo())["id"]
 
-    def get_chat_title(self, chat_id: str) -> str:
-        chat_title = vk.messages.getConversationsById(
-            peer_ids=2000000000 + chat_id
-        )["items"][0]["chat_settings"]["title"]
-        return chat_title
+    async def get_profiles(self, user_ids) -> dict:
+        return await profiles.resolve(vk, user_ids)
 
+    async def get_profile(self, user_id):
+        return await profiles.get(vk, user_id)
 
-class UserPhotoDownloader:
-    def __init__(self, user_id, parent_dir=DOWNLOADS_DIR):
-        self.user_id = int(user_id)
-        self.parent_dir = parent_dir
+    async def get_username(self, user_id: str):
+        user = await self.get_profile(user_id)
+        return f"{user['first_name']} {user['last_name']}"
 
-    def get_photos(self):
-        photos = []
-       
-        offset = 0
-        while True:
-            # Собираем фото с сохраненок
-            photos_by_saved = vk.photos.get(
-                user_id=self.user_id,
-                count=100,
-                offset=offset,
-                album_id="saved",
-                photo_sizes=True,
-                extended=True
-            )["items"]
+    async def get_group(self, group_id):
+        group_id = int(group_id)
 
-            raw_data = photos_by_saved#photos_by_wall + photos_by_profile
+        async def fetch():
+            groups = await vk.groups.getById(group_id=group_id)
+            return groups[0] if groups else None
+        return await metadata.get_or_fetch(f"group:{group_id}", fetch)
 
-            for photo in raw_data:
-                photos.append({
-                    "id": photo["id"],
-                    "owner_id": photo["owner_id"],
-                    "url": photo["sizes"][-1]["url"],
-                    "likes": photo["likes"]["count"],
-                    "date": photo["date"]
-                })
-            
-            if len(raw_data) < 100:
-                break
-            offset += 100
+    async def get_conversation(self, chat_id: int):
+        return await metadata.get_or_fetch(
+            f"chat:{chat_id}",
+            lambda: vk.messages.getConversationsById(peer_ids=2000000000 + chat_id)
+        )
 
-        offset = 0
-        while True:
-            # Собираем фото с профиля
-            photos_by_profile = vk.photos.get(
-                user_id=self.user_id,
-                count=100,
-                offset=offset,
-                album_id="profile",
-                photo_sizes=True,
-                extended=True
-            )["items"]
+    async def get_group_title(self, group_id: str):
+        group_info = await self.get_group(group_id)
+        group_name = group_info["name"].replace("/", " ").replace("|", " ").replace(".", " ").strip()
+        return group_name
 
-            raw_data = photos_by_profile#photos_by_wall + photos_by_profile
+    async def get_chat_title(self, chat_id: str) -> str:
+        chat_title = (await self.get_conversation(int(chat_id)))["items"][0]["chat_settings"]["title"]
+        return chat_title
 
-            for photo in raw_data:
-                photos.append({
+    async def get_attachments(self, peer_id: int, source: str, size_policy: SizePolicy = None):
+        """
+        Фото из вложений переписки по мере получения страниц.
+        Курсор сохраняется в манифест с отставанием на очередь загрузки и число воркеров,
+        так что после прерывания обход продолжается с места, до которого всё уже скачано
+        """
+        start_from = state.get_page_cursor(source)
+        if start_from:
+            logging.info("Продолжаем с места, на котором остановились в прошлый раз")
+
+        pages = deque()  # (номер первого фото страницы, курсор страницы)
+        saved = start_from
+        photos_count = 0
+        async for cursor, items in get_history_attachments(vk, peer_id, start_from=start_from):
+            if cursor:
+                pages.append((photos_count, cursor))
+            # Всё, что отдано раньше чем QUEUE_SIZE + max_limit фото назад, уже обработано
+            done = photos_count - QUEUE_SIZE - limiter.max_limit
+            while len(pages) > 1 and pages[1][0] <= done:
+                pages.popleft()
+            if pages and pages[0][0] <= done and pages[0][1] != saved:
+                saved = pages[0][1]
+                state.set_page_cursor(source, saved)
+
+            for item in items:
+                photo = item["attachment"]["photo"]
+                photos_count += 1
+                yield {
                     "id": photo["id"],
                     "owner_id": photo["owner_id"],
-                    "url": photo["sizes"][-1]["url"],
-                    "likes": photo["likes"]["count"],
-                    "date": photo["date"]
-                })
-            
-            if len(raw_data) < 100:
-                break
-            offset += 100
+                    **(size_policy or default_size_policy).pick(photo),
+                    "date": photo.get("date")
+                }
 
-        offset = 0
-        while True:
-            # Собираем фото со стены
-            photos_by_wall = vk.photos.get(
-                user_id=self.user_id,
-                count=100,
-                offset=offset,
-                album_id="wall",
-                photo_sizes=True,
-                extended=True
-            )["items"]
-
-            raw_data = photos_by_wall#photos_by_wall + photos_by_profile
 
-            for photo in raw_data:
-                photos.append({
-                    "id": photo["id"],
-                    "owner_id": photo["owner_id"],
-                    "url": photo["sizes"][-1]["url"],
-                    "likes": photo["likes"]["count"],
-                    "date": photo["date"]
-                })
-            
-            if len(raw_data) < 100:
-                break
-            offset += 100
-        
-        offset = 0
-        while True:
-            all_photos = vk.photos.getAll(
-                owner_id = self.user_id,
-                count=100,
-                offset=offset,
-                photo_sizes=True,
-                extended=True
-            )["items"]
+class UserPhotoDownloader:
+    def __init__(self, user_id, parent_dir=DOWNLOADS_DIR, dates=None, size_policy: SizePolicy = None):
+        self.user_id = int(user_id)
+        self.parent_dir = parent_dir
+        self.dates = dates
+        self.size_policy = size_policy or default_size_policy
+        self.source = f"photos:{self.user_id}"
+        self.lost_pages = 0
 
-            raw_data = all_photos#photos_by_wall + photos_by_profile
+    async def get_photos(self, stop=None):
+        """
+        stop — условие, на котором обход останавливается
+        (при инкрементальной синхронизации — уже скачанное фото)
+        """
+        # photos.getAll уже включает фото профиля и со стены,
+        # поэтому отдельно запрашиваем только сохранённые
+        raw_data, self.lost_pages = await get_all_items(vk, [
+            ("photos.getAll", {
+                "owner_id": self.user_id,
+                "photo_sizes": 1,
+                "extended": 1,
+                "no_service_albums": 0
+            }),
+            ("photos.get", {
+                "owner_id": self.user_id,
+                "album_id": "saved",
+                "photo_sizes": 1,
+                "extended": 1,
+                "rev": 1
+            })
+        ], stop=stop)
 
-            for photo in raw_data:
-                photos.append({
-                    "id": photo["id"],
-                    "owner_id": photo["owner_id"],
-                    "url": photo["sizes"][-1]["url"],
-                    "likes": photo["likes"]["count"],
-                    "date": photo["date"]
-                })
-            
-            if len(raw_data) < 100:
-                break
-            offset += 100
+        photos = []
+        for photo in raw_data:
+            photos.append({
+                "id": photo["id"],
+                "owner_id": photo["owner_id"],
+                **self.size_policy.pick(photo),
+                "likes": photo["likes"]["count"],
+                "date": photo["date"]
+            })
 
         return photos
 
     async def main(self):
-        user_info = vk.users.get(
-            user_ids=self.user_id,
-            fields="sex, photo_max_orig"
-        )[0]
+        user_info = await utils.get_profile(self.user_id)
+        if user_info is None:
+            logging.info(f"Пользователя с id {self.user_id} не существует")
+            return 0
 
         decline_username = decline(
             first_name=user_info["first_name"],
@@ -275,7 +288,7 @@ class UserPhotoDownloader:
             sex=user_info["sex"]
         )
 
-        username = utils.get_username(self.user_id)
+        username = f"{user_info['first_name']} {user_info['last_name']}"
 
         photos_path = self.parent_dir.joinpath(username)
         utils.create_dir(photos_path)
@@ -284,6 +297,7 @@ class UserPhotoDownloader:
         if "deactivated" in user_info:
             logging.info("Эта страница удалена")
             utils.remove_dir(photos_path)
+            return 0
         else:
             # Профиль закрыт
             if user_info["is_closed"] and not user_info["can_access_closed"]:
@@ -297,8 +311,13 @@ class UserPhotoDownloader:
             else:
                 logging.info(f"Получаем фотографии {decline_username}...")
 
+                # При повторном запуске останавливаемся на уже скачанных фото
+                stop = None
+                if config.get("incremental") and state.get_cursor(self.source) is not None:
+                    stop = lambda photo: state.has_photo(photos_path, photo["owner_id"], photo["id"])
+
                 # Получаем фотографии пользователя
-                photos = self.get_photos()
+                photos = await self.get_photos(stop)
 
             # Сортируем фотографии пользователя по дате
             photos.sort(key=lambda k: k["date"], reverse=True)
@@ -312,7 +331,15 @@ class UserPhotoDownloader:
             time_start = time.time()
 
             # Скачиваем фотографии пользователя
-            await download_photos(photos_path, photos)
+            photos_count, _ = await download_photos(photos_path, photos, limiter, state, store, self.dates)
+            if self.lost_pages:
+                logging.info("Не удалось получить {} — при следующем запуске фото будут запрошены снова".format(
+                    numeral.get_plural(self.lost_pages, "страницу фотографий, страницы фотографий, страниц фотографий")
+                ))
+            # Фото вне промежутка дат или с потерянных страниц не скачивались, поэтому курсор
+            # не сохраняется: иначе следующий инкрементальный запуск их уже не увидит
+            if photos and not has_dates(self.dates) and not self.lost_pages:
+                state.set_cursor(self.source, max(photo.get("date", 0) for photo in photos))
 
             time_finish = time.time()
             download_time = math.ceil(time_finish - time_start)
@@ -321,31 +348,74 @@ class UserPhotoDownloader:
                 numeral.get_plural(len(photos), "фотография, фотографии, фотографий"),
                 numeral.get_plural(download_time, "секунду, секунды, секунд")
             ))
+            return photos_count
 
 
 class UsersPhotoDownloader:
-    def __init__(self, user_ids: list, parent_dir=DOWNLOADS_DIR):
+    def __init__(self, user_ids: list, parent_dir=DOWNLOADS_DIR, dates=None, size_policy: SizePolicy = None):
         self.user_ids = [id for id in user_ids]
         self.parent_dir = parent_dir
+        self.dates = dates
+        self.size_policy = size_policy or default_size_policy
+        self.failed = 0  # Сколько пользователей не удалось скачать
+
+    async def download_user(self, user_id, semaphore: asyncio.Semaphore):
+        async with semaphore:
+            try:
+                return await UserPhotoDownloader(user_id, self.parent_dir, self.dates, self.size_policy).main()
+            except Exception as e:
+                logging.info(f"Не удалось скачать фотографии пользователя {user_id}: {e}")
+                self.failed += 1
+                return 0
 
     async def main(self):
-        for user_id in self.user_ids:
-            await UserPhotoDownloader(user_id, self.parent_dir).main()
+        # Пока одни пользователи обходятся через API, фото других уже скачиваются.
+        # Общие ограничения — частота запросов токенов (vk) и число загрузок (limiter)
+        semaphore = asyncio.Semaphore(config.get("users_concurrency", 4))
+        # Профили всех пользователей запрашиваются заранее, пачками по 1000
+        await utils.get_profiles(self.user_ids)
+        photos_count = sum(await asyncio.gather(*[
+            self.download_user(user_id, semaphore) for user_id in self.user_ids
+        ]))
+        if self.failed:
+            logging.info(f"Не удалось скачать фотографии {self.failed} из {len(self.user_ids)} пользователей")
+        return photos_count
 
 
 class GroupPhotoDownloader:
-    def __init__(self, group_id: str):
+    def __init__(self, group_id: str, videos=None, dates=None, size_policy: SizePolicy = None):
+        """
+        videos — скачивать ли видео (None — спросить), dates — (с, по) в unix time,
+        size_policy — какой размер фото скачивать (по умолчанию из config.yaml)
+        """
         self.group_id = int(group_id)
+        self.videos = videos
+        self.dates = dates
+        self.size_policy = size_policy or default_size_policy
 
-    async def get_photos(self, download_videos):
+    async def get_photos(self):
+        """
+        Асинхронный генератор: отдаёт фото со стены по мере получения страниц,
+        чтобы загрузка начиналась, не дожидаясь обхода всей стены.
+        При инкрементальной синхронизации обход заканчивается на первом уже обработанном посте
+        """
+        newest = state.get_cursor(f"wall:{-self.group_id}") if config.get("incremental") else None
         offset = 0
         while True:
-            posts = vk.wall.get(
+            posts = (await vk.wall.get(
                 owner_id=-self.group_id,
                 count=100,
                 offset=offset
-            )["items"]
+            ))["items"]
             for post in posts:
+                # Дальше идут уже синхронизированные посты (закреплённый пост может быть старым)
+                if newest is not None and post["id"] <= newest and not post.get("is_pinned"):
+                    return
+                # Стена идёт от новых постов к старым: дальше только посты раньше начала промежутка
+                if self.dates and self.dates[0] is not None and post["date"] < self.dates[0] \
+                        and not post.get("is_pinned"):
+                    return
+                self.newest_post_id = max(self.newest_post_id, post["id"])
 
                 # Пропускаем посты с рекламой
                 if post["marked_as_ads"]:
@@ -354,58 +424,77 @@ class GroupPhotoDownloader:
                 # Если пост скопирован с другой группы
                 if "copy_history" in post:
                     if "attachments" in post["copy_history"][0]:
-                        self.get_single_post(post["copy_history"][0])
+                        # Датой репоста считается дата его появления на стене
+                        for photo in self.get_single_post(post["copy_history"][0], date=post["date"]):
+                            yield photo
 
                 elif "attachments" in post:
-                    self.get_single_post(post)
+                    for photo in self.get_single_post(post):
+                        yield photo
 
             if len(posts) < 100:
                 break
 
             offset += 100
-        if download_videos == "1":
-            logging.info("Получаем список видео")
-            offset = 0
-            while True:
-                videos = vk.video.get(
-                    owner_id=-self.group_id,
-                    count=100,
-                    offset=offset
-                )["items"]
-                for video in videos:
-                    if "player" in video:
-                        self.videos_list.append({
-                            "type": video.get("type"),
-                            "id": video.get("id"),
-                            "owner_id": video.get("owner_id"),
-                            "title": video.get("title"),
-                            "player": video.get("player")
-                        })
-
-                if len(videos) < 100:
-                    logging.info(f"Всего получено {len(self.videos_list)} видео")
-                    break
-
-                offset += 100
-
-    def get_single_post(self, post: dict):
+
+    async def download_videos(self, group_dir: Path):
+        """Ошибка при получении или загрузке видео только записывается в лог, чтобы не прервать загрузку фото"""
+        try:
+            await self.get_videos()
+            logging.info("Скачиваем видео")
+            failed = await download_videos(
+                group_dir, self.videos_list, config.get("video_workers", 2), config.get("video_fragments", 4)
+            )
+        except Exception as e:
+            logging.info(f"Не удалось скачать видео группы: {e!r}")
+            return
+        if failed:
+            logging.info(f"Не удалось скачать видео: {failed}")
+
+    async def get_videos(self):
+        logging.info("Получаем список видео")
+        offset = 0
+        while True:
+            videos = (await vk.video.get(
+                owner_id=-self.group_id,
+                count=100,
+                offset=offset
+            ))["items"]
+            for video in videos:
+                if "player" in video and (not self.dates or in_dates(video, self.dates)):
+                    self.videos_list.append({
+                        "type": video.get("type"),
+                        "id": video.get("id"),
+                        "owner_id": video.get("owner_id"),
+                        "title": video.get("title"),
+                        "player": video.get("player")
+                    })
+
+            if len(videos) < 100:
+                logging.info(f"Всего получено {len(self.videos_list)} видео")
+                break
+
+            offset += 100
+
+    def get_single_post(self, post: dict, date=None):
         """
-        Проходимся по всем вложениям поста и отбираем только картинки
+        Проходимся по всем вложениям поста и отбираем только картинки.
+        date — дата поста на стене (по умолчанию дата самого поста)
         """
+        photos = []
         try:
             for i, attachment in enumerate(post["attachments"]):
                 if attachment["type"] == "photo":
                     file_type = attachment["type"]
                     photo_id = post["attachments"][i]["photo"]["id"]
                     owner_id = post["attachments"][i]["photo"]["owner_id"]
-                    photo_url = post["attachments"][i]["photo"]["sizes"][-1].get("url")
-                    if photo_url != None or photo_url != '':
-                        self.photos.append({
-                            "type": file_type,
-                            "id": photo_id,
-                            "owner_id": -owner_id,
-                            "url": photo_url
-                        })
+                    photos.append({
+                        "type": file_type,
+                        "id": photo_id,
+                        "owner_id": -owner_id,
+                        "date": date or post.get("date"),
+                        **self.size_policy.pick(post["attachments"][i]["photo"])
+                    })
                 '''#Too slow      
                 if attachment["type"] == "video" and download_videos == "1":
                     file_type = attachment["type"]
@@ -427,61 +516,59 @@ class GroupPhotoDownloader:
                     })'''
         except Exception as e:
             print(e)
+        return photos
 
     async def main(self):
         # Получаем информацию о группе
-        group_info = vk.groups.getById(group_id=self.group_id)[0]
-        group_name = group_info["name"].replace("/", " ").replace("|", " ").replace(".", " ").strip()
+        group_info = await utils.get_group(self.group_id)
+        group_name = await utils.get_group_title(self.group_id)
 
         group_dir = DOWNLOADS_DIR.joinpath(group_name)
         utils.create_dir(group_dir)
 
-        self.photos = []
+        self.photos_count = 0
+        self.newest_post_id = 0
         self.videos_list = []
 
         # Группа закрыта
         if group_info["is_closed"]:
             logging.info(f"Группа '{group_name}' закрыта :(")
-            self.photos = [{
+            time_start = time.time()
+            self.photos_count, dublicates_count = await download_photos(group_dir, [{
                 "id": self.group_id,
                 "owner_id": self.group_id,
                 "url": "https://vk.com/images/community_200.png"
-            }]
+            }], limiter, state, store)
         else:
-            download_vid = input("Скачать также видео? 1-да 2-нет\n> ")
+            if self.videos is None:
+                download_vid = input("Скачать также видео? 1-да 2-нет\n> ")
+            else:
+                download_vid = "1" if self.videos else "2"
             if download_vid == "1":
                 logging.info(f"Получаем фотографии и видео группы '{group_name}'...")
-                await self.get_photos(download_vid)
-                logging.info("{} {} {}".format(
-                numeral.choose_plural(len(self.photos), "Будет, Будут, Будут"),
-                numeral.choose_plural(len(self.photos), "скачена, скачены, скачены"),
-                numeral.get_plural(len(self.photos), "фотография, фотографии, фотографий")
-                ))
 
                 time_start = time.time()
 
-                # Скачиваем фотографии со стены группы
-                await download_photos(group_dir, self.photos)
-                logging.info("Скачиваем видео")
-                await download_videos(group_dir, self.videos_list)
+                # Видео качаются в отдельных процессах одновременно с фотографиями
+                (self.photos_count, dublicates_count), _ = await asyncio.gather(
+                    download_photos(group_dir, self.get_photos(), limiter, state, store, self.dates),
+                    self.download_videos(group_dir)
+                )
 
             elif download_vid == "2":
                 logging.info(f"Получаем фотографии группы '{group_name}'...")
-                await self.get_photos(download_vid)
-                logging.info("{} {} {}".format(
-                numeral.choose_plural(len(self.photos), "Будет, Будут, Будут"),
-                numeral.choose_plural(len(self.photos), "скачена, скачены, скачены"),
-                numeral.get_plural(len(self.photos), "фотография, фотографии, фотографий")
-                ))
 
                 time_start = time.time()
 
-                # Скачиваем фотографии со стены группы
-                await download_photos(group_dir, self.photos)
+                # Скачиваем фотографии по мере обхода стены группы
+                self.photos_count, dublicates_count = await download_photos(group_dir, self.get_photos(), limiter, state, store, self.dates)
             else:
                 logging.info("Введено некорректное значение")
-                time.sleep(0.1)
-                exit
+                return 0
+
+            # С промежутком дат обойдена только часть стены — курсор не сохраняется
+            if self.newest_post_id and not has_dates(self.dates):
+                state.set_cursor(f"wall:{-self.group_id}", self.newest_post_id)
             #logging.info(f"Получаем фотографии группы '{group_name}'...")
 
             # Получаем фотографии со стены группы
@@ -491,31 +578,47 @@ class GroupPhotoDownloader:
         download_time = math.ceil(time_finish - time_start)
 
         logging.info("{} {} за {}".format(
-            numeral.choose_plural(len(self.photos), "Скачена, Скачены, Скачены"),
-            numeral.get_plural(len(self.photos), "фотография, фотографии, фотографий"),
+            numeral.choose_plural(self.photos_count, "Скачена, Скачены, Скачены"),
+            numeral.get_plural(self.photos_count, "фотография, фотографии, фотографий"),
             numeral.get_plural(download_time, "секунду, секунды, секунд")
         ))
 
-        logging.info("Проверка на дубликаты")
-        dublicates_count = check_for_duplicates(group_dir)
-        logging.info(f"Дубликатов удалено: {dublicates_count}")
+        logging.info(f"Дубликатов пропущено: {dublicates_count}")
 
-        logging.info(f"Итого скачено: {len(self.photos) - dublicates_count} фото")
+        logging.info(f"Итого скачено: {self.photos_count - dublicates_count} фото")
+        return self.photos_count
 
 
 class GroupsPhotoDownloader:
-    def __init__(self, group_ids: str):
+    def __init__(self, group_ids: str, videos=None, dates=None, size_policy: SizePolicy = None):
         self.group_ids = [int(id.strip()) for id in group_ids.split(",")]
+        self.videos = videos
+        self.dates = dates
+        self.size_policy = size_policy or default_size_policy
 
-    async def get_photos(self, group_id, download_videos):
+    async def get_photos(self, group_id):
+        """
+        Асинхронный генератор: отдаёт фото со стены по мере получения страниц,
+        чтобы загрузка начиналась, не дожидаясь обхода всей стены.
+        При инкрементальной синхронизации обход заканчивается на первом уже обработанном посте
+        """
+        newest = state.get_cursor(f"wall:{-group_id}") if config.get("incremental") else None
         offset = 0
         while True:
-            posts = vk.wall.get(
+            posts = (await vk.wall.get(
                 owner_id=-group_id,
                 count=100,
                 offset=offset
-            )["items"]
+            ))["items"]
             for post in posts:
+                # Дальше идут уже синхронизированные посты (закреплённый пост может быть старым)
+                if newest is not None and post["id"] <= newest and not post.get("is_pinned"):
+                    return
+                # Стена идёт от новых постов к старым: дальше только посты раньше начала промежутка
+                if self.dates and self.dates[0] is not None and post["date"] < self.dates[0] \
+                        and not post.get("is_pinned"):
+                    return
+                self.newest_post_ids[group_id] = max(self.newest_post_ids.get(group_id, 0), post["id"])
 
                 # Пропускаем посты с рекламой
                 if post["marked_as_ads"]:
@@ -524,58 +627,77 @@ class GroupsPhotoDownloader:
                 # Если пост скопирован с другой группы
                 if "copy_history" in post:
                     if "attachments" in post["copy_history"][0]:
-                        self.get_single_post(post["copy_history"][0])
+                        # Датой репоста считается дата его появления на стене
+                        for photo in self.get_single_post(post["copy_history"][0], date=post["date"]):
+                            yield photo
 
                 elif "attachments" in post:
-                    self.get_single_post(post)
+                    for photo in self.get_single_post(post):
+                        yield photo
 
             if len(posts) < 100:
                 break
 
             offset += 100
-        if download_videos == "1":
-            logging.info("Получаем список видео")
-            offset = 0
-            while True:
-                videos = vk.video.get(
-                    owner_id=-group_id,
-                    count=100,
-                    offset=offset
-                )["items"]
-                for video in videos:
-                    if "player" in video:
-                        self.videos_list.append({
-                            "type": video.get("type"),
-                            "id": video.get("id"),
-                            "owner_id": video.get("owner_id"),
-                            "title": video.get("title"),
-                            "player": video.get("player")
-                        })
-
-                if len(videos) < 100:
-                    logging.info(f"Всего получено {len(self.videos_list)} видео")
-                    break
-
-                offset += 100
-
-    def get_single_post(self, post: dict):
+
+    async def download_videos(self, group_dir: Path):
+        """Ошибка при получении или загрузке видео только записывается в лог, чтобы не прервать загрузку фото"""
+        try:
+            await asyncio.gather(*[self.get_videos(group_id) for group_id in self.group_ids])
+            logging.info("Скачиваем видео")
+            failed = await download_videos(
+                group_dir, self.videos_list, config.get("video_workers", 2), config.get("video_fragments", 4)
+            )
+        except Exception as e:
+            logging.info(f"Не удалось скачать видео групп: {e!r}")
+            return
+        if failed:
+            logging.info(f"Не удалось скачать видео: {failed}")
+
+    async def get_videos(self, group_id):
+        logging.info("Получаем список видео")
+        offset = 0
+        while True:
+            videos = (await vk.video.get(
+                owner_id=-group_id,
+                count=100,
+                offset=offset
+            ))["items"]
+            for video in videos:
+                if "player" in video and (not self.dates or in_dates(video, self.dates)):
+                    self.videos_list.append({
+                        "type": video.get("type"),
+                        "id": video.get("id"),
+                        "owner_id": video.get("owner_id"),
+                        "title": video.get("title"),
+                        "player": video.get("player")
+                    })
+
+            if len(videos) < 100:
+                logging.info(f"Всего получено {len(self.videos_list)} видео")
+                break
+
+            offset += 100
+
+    def get_single_post(self, post: dict, date=None):
         """
-        Проходимся по всем вложениям поста и отбираем только картинки
+        Проходимся по всем вложениям поста и отбираем только картинки.
+        date — дата поста на стене (по умолчанию дата самого поста)
         """
+        photos = []
         try:
             for i, attachment in enumerate(post["attachments"]):
                 if attachment["type"] == "photo":
                     file_type = attachment["type"]
                     photo_id = post["attachments"][i]["photo"]["id"]
                     owner_id = post["attachments"][i]["photo"]["owner_id"]
-                    photo_url = post["attachments"][i]["photo"]["sizes"][-1].get("url")
-                    if photo_url != None or photo_url != '':
-                        self.photos.append({
-                            "type": file_type,
-                            "id": photo_id,
-                            "owner_id": owner_id,
-                            "url": photo_url
-                        })
+                    photos.append({
+                        "type": file_type,
+                        "id": photo_id,
+                        "owner_id": owner_id,
+                        "date": date or post.get("date"),
+                        **self.size_policy.pick(post["attachments"][i]["photo"])
+                    })
                 '''#Too slow      
                 if attachment["type"] == "video" and download_videos == "1":
                     file_type = attachment["type"]
@@ -597,99 +719,97 @@ class GroupsPhotoDownloader:
                     })'''
         except Exception as e:
             print(e)
+        return photos
+
+    async def get_group_photos(self, group_id):
+        """Фото одной группы: со стены или заглушка, если группа закрыта"""
+        group_info = await utils.get_group(group_id)
+        # Группа закрыта
+        if group_info["is_closed"]:
+            logging.info(f"Группа '{group_info['name']}' закрыта :(")
+            yield {
+                "id": group_id,
+                "owner_id": -group_id,
+                "url": "https://vk.com/images/community_200.png"
+            }
+        else:
+            async for photo in self.get_photos(group_id):
+                yield photo
 
     async def main(self):
-        #download_vid = input("Скачать также видео? 1-да 2-нет (сначала будут скачены видео)\n> ")
-        groups_name = ", ".join([utils.get_group_title(group_id) for group_id in self.group_ids])
+        groups_name = ", ".join(await asyncio.gather(*[
+            utils.get_group_title(group_id) for group_id in self.group_ids
+        ]))
         group_dir = DOWNLOADS_DIR.joinpath(groups_name)
-        self.photos = []
+        utils.create_dir(group_dir)
+        self.newest_post_ids = {}
         self.videos_list = []
 
-        download_vid = input("Скачать также видео? 1-да 2-нет\n> ")
-        
-        for group_id in self.group_ids:
-            group_info = vk.groups.getById(group_id=group_id)[0]
-            # Группа закрыта
-            if group_info["is_closed"]:
-                logging.info(f"Группа '{groups_name}' закрыта :(")
-                self.photos = [{
-                    "id": group_id,
-                    "owner_id": -group_id,
-                    "url": "https://vk.com/images/community_200.png"
-                }]
-            else:
-                if download_vid == "1":
-                    logging.info(f"Получаем фотографии и видео группы '{groups_name}'...")
-                    await self.get_photos(group_id, download_vid)
-                    logging.info("{} {} {}".format(
-                    numeral.choose_plural(len(self.photos), "Будет, Будут, Будут"),
-                    numeral.choose_plural(len(self.photos), "скачена, скачены, скачены"),
-                    numeral.get_plural(len(self.photos), "фотография, фотографии, фотографий")
-                    ))
-
-                    time_start = time.time()
-
-                    # Скачиваем фотографии со стены группы
-                    await download_photos(group_dir, self.photos)
-                    logging.info("Скачиваем видео")
-                    await download_videos(group_dir, self.videos_list)
-
-                elif download_vid == "2":
-                    logging.info(f"Получаем фотографии группы '{groups_name}'...")
-                    await self.get_photos(group_id, download_vid)
-                    logging.info("{} {} {}".format(
-                    numeral.choose_plural(len(self.photos), "Будет, Будут, Будут"),
-                    numeral.choose_plural(len(self.photos), "скачена, скачены, скачены"),
-                    numeral.get_plural(len(self.photos), "фотография, фотографии, фотографий")
-                    ))
-
-                    time_start = time.time()
-
-                    # Скачиваем фотографии со стены группы
-                    await download_photos(group_dir, self.photos)
-                else:
-                    logging.info("Введено некорректное значение")
-                    time.sleep(0.1)
-                    exit
-                #logging.info(f"Получаем фотографии группы '{group_name}'...")
+        if self.videos is None:
+            download_vid = input("Скачать также видео? 1-да 2-нет\n> ")
+        else:
+            download_vid = "1" if self.videos else "2"
+        if download_vid == "1":
+            logging.info(f"Получаем фотографии и видео групп '{groups_name}'...")
+        elif download_vid == "2":
+            logging.info(f"Получаем фотографии групп '{groups_name}'...")
+        else:
+            logging.info("Введено некорректное значение")
+            return 0
 
-                # Получаем фотографии со стены группы
-                #await self.get_photos(group_dir)
+        time_start = time.time()
 
-            time_finish = time.time()
-            download_time = math.ceil(time_finish - time_start)
+        # Стены всех групп обходятся одновременно, запросы распределяются между токенами,
+        # а фото скачиваются по мере обхода. Видео качаются в отдельных процессах параллельно с фото
+        jobs = [download_photos(group_dir, merge_photos(*[
+            self.get_group_photos(group_id) for group_id in self.group_ids
+        ]), limiter, state, store, self.dates)]
+        if download_vid == "1":
+            jobs.append(self.download_videos(group_dir))
+        (self.photos_count, dublicates_count), *_ = await asyncio.gather(*jobs)
 
-            logging.info("{} {} за {}".format(
-                numeral.choose_plural(len(self.photos), "Скачена, Скачены, Скачены"),
-                numeral.get_plural(len(self.photos), "фотография, фотографии, фотографий"),
-                numeral.get_plural(download_time, "секунду, секунды, секунд")
-            ))
+        # С промежутком дат обойдена только часть стен — курсоры не сохраняются
+        if not has_dates(self.dates):
+            for group_id, newest_post_id in self.newest_post_ids.items():
+                state.set_cursor(f"wall:{-group_id}", newest_post_id)
+
+        time_finish = time.time()
+        download_time = math.ceil(time_finish - time_start)
+
+        logging.info("{} {} за {}".format(
+            numeral.choose_plural(self.photos_count, "Скачена, Скачены, Скачены"),
+            numeral.get_plural(self.photos_count, "фотография, фотографии, фотографий"),
+            numeral.get_plural(download_time, "секунду, секунды, секунд")
+        ))
 
-            logging.info("Проверка на дубликаты")
-            dublicates_count = check_for_duplicates(group_dir)
-            logging.info(f"Дубликатов удалено: {dublicates_count}")
+        logging.info(f"Дубликатов пропущено: {dublicates_count}")
 
-            logging.info(f"Итого скачено: {len(self.photos) - dublicates_count} фото")
+        logging.info(f"Итого скачено: {self.photos_count - dublicates_count} фото")
+        return self.photos_count
 
 
 class ChatMembersPhotoDownloader:
-    def __init__(self, chat_id: str):
+    def __init__(self, chat_id: str, dates=None, size_policy: SizePolicy = None):
         self.chat_id = int(chat_id)
+        self.dates = dates
+        self.size_policy = size_policy or default_size_policy
+        self.failed = 0
 
     async def main(self):
-        chat_title = utils.get_chat_title(self.chat_id)
+        chat_title = await utils.get_chat_title(self.chat_id)
         chat_path = DOWNLOADS_DIR.joinpath(chat_title)
 
         # Создаём папку с фотографиями участников беседы, если её не существует
         utils.create_dir(chat_path)
 
-        members = vk.messages.getChat(
+        members = (await vk.messages.getChat(
             chat_id=self.chat_id
-        )["users"]
+        ))["users"]
 
         if members == []:
             logging.info("Вы вышли из этой беседы")
             utils.remove_dir(chat_path)
+            return 0
         else:
             members_ids = []
 
@@ -697,16 +817,24 @@ class ChatMembersPhotoDownloader:
                 if member_id > 0:
                     members_ids.append(member_id)
 
-            members_ids.remove(utils.get_user_id())
+            members_ids.remove(await utils.get_user_id())
 
-            await UsersPhotoDownloader(user_ids=members_ids, parent_dir=chat_path).main()
+            downloader = UsersPhotoDownloader(user_ids=members_ids, parent_dir=chat_path, dates=self.dates,
+                                              size_policy=self.size_policy)
+            photos_count = await downloader.main()
+            self.failed = downloader.failed
+            return photos_count
 
 
 class ChatPhotoDownloader:
-    def __init__(self, chat_id: str):
+    def __init__(self, chat_id: str, dates=None, size_policy: SizePolicy = None):
         self.chat_id = int(chat_id)
+        self.dates = dates
+        self.size_policy = size_policy or default_size_policy
+        self.peer_id = 2000000000 + self.chat_id
+        self.source = f"attachments:{self.peer_id}"
 
-    def download_chat_photo(self):
+    async def download_chat_photo(self):
         """
         Скачиваем аватарку беседы если она есть
         """
@@ -716,281 +844,344 @@ class ChatPhotoDownloader:
             photo_url = sizes[max_size]
             photo_path = self.chat_dir.joinpath("Аватарка беседы.png")
 
-            response = requests.get(photo_url)
-            if response.status_code == 200:
-                with open(photo_path, mode="wb") as f:
-                    f.write(response.content)
+            await download_photo(transport.get_session(), photo_url, photo_path)
 
     def get_attachments(self):
-        raw_data = vk.messages.getHistoryAttachments(
-            peer_id=2000000000 + self.chat_id,
-            media_type="photo"
-        )["items"]
-
-        photos = []
-
-        for photo in raw_data:
-            photos.append({
-                "id": photo["attachment"]["photo"]["id"],
-                "owner_id": photo["attachment"]["photo"]["owner_id"],
-                "url": photo["attachment"]["photo"]["sizes"][-1]["url"]
-            })
-
-        return photos
+        return utils.get_attachments(self.peer_id, self.source, self.size_policy)
 
     async def main(self):
-        chat_title = utils.get_chat_title(self.chat_id)
+        chat_title = await utils.get_chat_title(self.chat_id)
         photos_path = DOWNLOADS_DIR.joinpath(chat_title)
         if not photos_path.exists():
             logging.info(f"Создаём папку с фотографиями беседы '{chat_title}'")
             photos_path.mkdir()
 
-        photos = self.get_attachments()
-
-        logging.info("{} {} {}".format(
-            numeral.choose_plural(len(photos), "Будет, Будут, Будут"),
-            numeral.choose_plural(len(photos), "скачена, скачены, скачены"),
-            numeral.get_plural(len(photos), "фотография, фотографии, фотографий")
-        ))
+        logging.info(f"Получаем вложения беседы '{chat_title}'...")
 
         time_start = time.time()
 
-        # Скачиваем вложения беседы
-        await download_photos(photos_path, photos)
+        # Скачиваем вложения беседы по мере обхода истории
+        photos_count, dublicates_count = await download_photos(photos_path, self.get_attachments(), limiter, state, store, self.dates)
+        state.set_page_cursor(self.source, None)
 
         time_finish = time.time()
         download_time = math.ceil(time_finish - time_start)
 
         logging.info("{} {} за {}".format(
-            numeral.choose_plural(len(photos), "Скачена, Скачены, Скачены"),
-            numeral.get_plural(len(photos), "фотография, фотографии, фотографий"),
+            numeral.choose_plural(photos_count, "Скачена, Скачены, Скачены"),
+            numeral.get_plural(photos_count, "фотография, фотографии, фотографий"),
             numeral.get_plural(download_time, "секунду, секунды, секунд")
         ))
 
-        logging.info("Проверка на дубликаты")
-        dublicates_count = check_for_duplicates(photos_path)
-        logging.info(f"Дубликатов удалено: {dublicates_count}")
+        logging.info(f"Дубликатов пропущено: {dublicates_count}")
 
-        logging.info(f"Итого скачено: {len(photos) - dublicates_count} фото")
+        logging.info(f"Итого скачено: {photos_count - dublicates_count} фото")
+        return photos_count
         
 class ChatUserPhotoDownloader:
-    def __init__(self, chat_id: str, parent_dir=DOWNLOADS_DIR):
+    def __init__(self, chat_id: str, parent_dir=DOWNLOADS_DIR, dates=None, size_policy: SizePolicy = None):
         self.chat_id = int(chat_id)
         self.parent_dir = parent_dir
+        self.dates = dates
+        self.size_policy = size_policy or default_size_policy
+        self.source = f"attachments:{self.chat_id}"
         
     def get_attachments(self):
-        raw_data = vk.messages.getHistoryAttachments(
-            peer_id=self.chat_id,
-            media_type="photo"
-        )["items"]
-
-        photos = []
+        return utils.get_attachments(self.chat_id, self.source, self.size_policy)
 
-        for photo in raw_data:
-            photos.append({
-                "id": photo["attachment"]["photo"]["id"],
-                "owner_id": photo["attachment"]["photo"]["owner_id"],
-                "url": photo["attachment"]["photo"]["sizes"][-1]["url"]
-            })
-
-        return photos
     async def main(self):
-        username = utils.get_username(self.chat_id)
+        username = await utils.get_username(self.chat_id)
 
         photos_path = self.parent_dir.joinpath(f"Переписка {username}")
         utils.create_dir(photos_path)
         
-        photos = self.get_attachments()
-        
-        logging.info("{} {} {}".format(
-            numeral.choose_plural(len(photos), "Будет, Будут, Будут"),
-            numeral.choose_plural(len(photos), "скачена, скачены, скачены"),
-            numeral.get_plural(len(photos), "фотография, фотографии, фотографий")
-        ))
+        logging.info(f"Получаем вложения переписки с {username}...")
 
         time_start = time.time()
-         
-        await download_photos(photos_path, photos)
+
+        # Скачиваем вложения переписки по мере обхода истории
+        photos_count, dublicates_count = await download_photos(photos_path, self.get_attachments(), limiter, state, store, self.dates)
+        state.set_page_cursor(self.source, None)
 
         time_finish = time.time()
         download_time = math.ceil(time_finish - time_start)
 
         logging.info("{} {} за {}".format(
-            numeral.choose_plural(len(photos), "Скачена, Скачены, Скачены"),
-            numeral.get_plural(len(photos), "фотография, фотографии, фотографий"),
+            numeral.choose_plural(photos_count, "Скачена, Скачены, Скачены"),
+            numeral.get_plural(photos_count, "фотография, фотографии, фотографий"),
             numeral.get_plural(download_time, "секунду, секунды, секунд")
         ))
 
-        logging.info("Проверка на дубликаты")
-        dublicates_count = check_for_duplicates(photos_path)
-        logging.info(f"Дубликатов удалено: {dublicates_count}")
+        logging.info(f"Дубликатов пропущено: {dublicates_count}")
 
-        logging.info(f"Итого скачено: {len(photos) - dublicates_count} фото")
+        logging.info(f"Итого скачено: {photos_count - dublicates_count} фото")
+        return photos_count
 
 
 class ChatUserPhotoDownloader:
-    def __init__(self, chat_id: str, parent_dir=DOWNLOADS_DIR):
+    def __init__(self, chat_id: str, parent_dir=DOWNLOADS_DIR, dates=None, size_policy: SizePolicy = None):
         self.chat_id = int(chat_id)
         self.parent_dir = parent_dir
+        self.dates = dates
+        self.size_policy = size_policy or default_size_policy
+        self.source = f"attachments:{self.chat_id}"
 
     def get_attachments(self):
-        raw_data = vk.messages.getHistoryAttachments(
-            peer_id=self.chat_id,
-            media_type="photo"
-        )["items"]
-
-        photos = []
-
-        for photo in raw_data:
-            photos.append({
-                "id": photo["attachment"]["photo"]["id"],
-                "owner_id": photo["attachment"]["photo"]["owner_id"],
-                "url": photo["attachment"]["photo"]["sizes"][-1]["url"]
-            })
+        return utils.get_attachments(self.chat_id, self.source, self.size_policy)
 
-        return photos
     async def main(self):
-        username = utils.get_username(self.chat_id)
+        username = await utils.get_username(self.chat_id)
 
         photos_path = self.parent_dir.joinpath(f"Переписка {username}")
         utils.create_dir(photos_path)
 
-        photos = self.get_attachments()
-
-        logging.info("{} {} {}".format(
-            numeral.choose_plural(len(photos), "Будет, Будут, Будут"),
-            numeral.choose_plural(len(photos), "скачена, скачены, скачены"),
-            numeral.get_plural(len(photos), "фотография, фотографии, фотографий")
-        ))
+        logging.info(f"Получаем вложения переписки с {username}...")
 
         time_start = time.time()
 
-        await download_photos(photos_path, photos)
+        # Скачиваем вложения переписки по мере обхода истории
+        photos_count, dublicates_count = await download_photos(photos_path, self.get_attachments(), limiter, state, store, self.dates)
+        state.set_page_cursor(self.source, None)
 
         time_finish = time.time()
         download_time = math.ceil(time_finish - time_start)
 
         logging.info("{} {} за {}".format(
-            numeral.choose_plural(len(photos), "Скачена, Скачены, Скачены"),
-            numeral.get_plural(len(photos), "фотография, фотографии, фотографий"),
+            numeral.choose_plural(photos_count, "Скачена, Скачены, Скачены"),
+            numeral.get_plural(photos_count, "фотография, фотографии, фотографий"),
             numeral.get_plural(download_time, "секунду, секунды, секунд")
         ))
 
-        logging.info("Проверка на дубликаты")
-        dublicates_count = check_for_duplicates(photos_path)
-        logging.info(f"Дубликатов удалено: {dublicates_count}")
-
-        logging.info(f"Итого скачено: {len(photos) - dublicates_count} фото")
+        logging.info(f"Дубликатов пропущено: {dublicates_count}")
+
+        logging.info(f"Итого скачено: {photos_count - dublicates_count} фото")
+        return photos_count
+
+
+async def run_job(job: dict):
+    """Запускает загрузчик для одного задания из файла заданий"""
+    ids, dates, size_policy = job["ids"], job["dates"], job["size_policy"]
+    if job["source"] == "user":
+        downloader = UserPhotoDownloader(ids[0], dates=dates, size_policy=size_policy)
+    elif job["source"] == "users":
+        downloader = UsersPhotoDownloader(ids, dates=dates, size_policy=size_policy)
+    elif job["source"] == "group":
+        downloader = GroupPhotoDownloader(ids[0], videos=job["videos"], dates=dates, size_policy=size_policy)
+    elif job["source"] == "groups":
+        downloader = GroupsPhotoDownloader(",".join(map(str, ids)), videos=job["videos"], dates=dates,
+                                           size_policy=size_policy)
+    elif job["source"] == "chat_members":
+        downloader = ChatMembersPhotoDownloader(ids[0], dates=dates, size_policy=size_policy)
+    elif job["source"] == "chat":
+        downloader = ChatPhotoDownloader(ids[0], dates=dates, size_policy=size_policy)
+    else:
+        downloader = ChatUserPhotoDownloader(ids[0], dates=dates, size_policy=size_policy)
+    photos_count = await downloader.main()
+    # Загрузчики нескольких пользователей не прерываются из-за одного, но задание должно считаться неудачным
+    failed = getattr(downloader, "failed", 0)
+    if failed:
+        raise JobFailed("не удалось скачать фотографии {}".format(
+            numeral.get_plural(failed, "пользователя, пользователей, пользователей")
+        ), photos_count)
+    return photos_count
 
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Скачивание фотографий пользователей, групп и бесед ВКонтакте")
+    parser.add_argument("--jobs", type=Path, help="JSONL-файл заданий: скачать всё без вопросов и выйти")
+    parser.add_argument("--concurrency", type=int, default=config.get("jobs_concurrency", 2),
+                        help="сколько заданий выполняется одновременно")
+    parser.add_argument("--report", type=Path, default=config.get("metrics_report"),
+                        help="сохранить в JSON отчёт о производительности по этапам")
+    parser.add_argument("--metrics-port", type=int, default=config.get("metrics_port"),
+                        help="отдавать метрики в формате Prometheus на http://127.0.0.1:PORT/metrics")
+    args = parser.parse_args()
+
     utils = Utils()
     utils.create_dir(DOWNLOADS_DIR)
+    state = SyncState(DOWNLOADS_DIR)
+    # Метаданные пользователей, групп и бесед; на диске — только если включено в config.yaml
+    metadata = MetadataCache(
+        DOWNLOADS_DIR.joinpath(METADATA_CACHE_FILENAME) if config.get("metadata_cache") else None,
+        ttl=config.get("metadata_ttl", 86400)
+    )
+    # Профили пользователей, общие для проверки id и всех загрузчиков
+    profiles = ProfileResolver(metadata)
+    store = ContentStore(DOWNLOADS_DIR.joinpath(STORE_DIRNAME)) if config.get("content_store") else None
+
+    vk = None
+    exit_code = 0
+
+    if args.metrics_port:
+        loop.run_until_complete(metrics.start_server(args.metrics_port))
+        logging.info(f"Метрики: http://127.0.0.1:{args.metrics_port}/metrics")
+
+    if args.jobs:
+        # Без вопросов: задания берутся из файла, в конце выводится итог по каждому
+        try:
+            jobs = load_jobs(args.jobs)
+        except (OSError, JobError) as e:
+            logging.info(f"Не удалось прочитать файл заданий: {e}")
+            sys.exit(2)
+        vk = utils.auth_by_token()
+        results = loop.run_until_complete(run_jobs(jobs, run_job, args.concurrency))
+        log_summary(results)
+        if any(result["status"] != "ok" for result in results):
+            exit_code = 1
+    else:
+        print("1. Скачать все фотографии пользователя")
+        print("2. Скачать все фотографии нескольких пользователей")
+        print("3. Скачать все фотографии со стены группы")
+        print("4. Скачать все фотографии нескольких групп")
+        print("5. Скачать все фотографии участников беседы")
+        print("6. Скачать все вложения беседы")
+        print("7. Скачать все фотографии пользователя")
+        print("8. Удалить дубликаты в папке загрузок")
+        print("9. Удалить из хранилища фото, которых больше нет ни в одной папке")
+        print("10. Найти похожие фото (одно фото в разном размере и качестве)")
+        print("11. Повторить загрузку фото, которые не удалось скачать")
 
-    print("1. Скачать все фотографии пользователя")
-    print("2. Скачать все фотографии нескольких пользователей")
-    print("3. Скачать все фотографии со стены группы")
-    print("4. Скачать все фотографии нескольких групп")
-    print("5. Скачать все фотографии участников беседы")
-    print("6. Скачать все вложения беседы")
-    print("7. Скачать все фотографии пользователя")
-
-    while True:
-        time.sleep(0.1)
-        downloader_type = input("> ")
-        if downloader_type == "1":
-            vk = utils.auth_by_token()
-            time.sleep(0.1)
-            while True:
-                id = input("Введите id пользователя\n> ")
-                if utils.check_user_id(id):
-                    downloader = UserPhotoDownloader(user_id=id)
-                    loop.run_until_complete(downloader.main())
-                    break
-                else:
-                    logging.info("Пользователя с таким id не существует")
-                    time.sleep(0.1)
-            break
-        elif downloader_type == "2":
-            vk = utils.auth_by_token()
-            time.sleep(0.1)
-            while True:
-                user_ids = input("Введите id пользователей через запятую\n> ")
-                if utils.check_user_ids(user_ids):
-                    downloader = UsersPhotoDownloader(user_ids=user_ids.split(","))
-                    loop.run_until_complete(downloader.main())
-                    break
-                else:
-                    logging.info("Пользователей с таким id не существует")
-                    time.sleep(0.1)
-            break
-        elif downloader_type == "3":
-            vk = utils.auth_by_token()
-            time.sleep(0.1)
-            while True:
-                id = input("Введите id группы \n> ")
-                if utils.check_group_id(id):
-                    downloader = GroupPhotoDownloader(group_id=id)
-                    loop.run_until_complete(downloader.main())
-                    break
-                else:
-                    logging.info("Группы с таким id не существует")
-                    time.sleep(0.1)
-            break
-        elif downloader_type == "4":
-            vk = utils.auth_by_token()
-            time.sleep(0.1)
-            while True:
-                group_ids = input("Введите id групп через запятую\n> ")
-                if utils.check_group_ids(group_ids):
-                    downloader = GroupsPhotoDownloader(group_ids=group_ids)
-                    loop.run_until_complete(downloader.main())
-                    break
-                else:
-                    logging.info("Групп с таким id не существует")
-                    time.sleep(0.1)
-            break
-        elif downloader_type == "5":
-            vk = utils.auth_by_token()
-            time.sleep(0.1)
-            while True:
-                id = input("Введите id беседы\n> ")
-                if utils.check_chat_id(id):
-                    downloader = ChatMembersPhotoDownloader(chat_id=id)
-                    loop.run_until_complete(downloader.main())
-                    break
-                else:
-                    logging.info("Беседы с таким id не существует")
-                    time.sleep(0.1)
-            break
-        elif downloader_type == "6":
-            vk = utils.auth_by_token()
-            time.sleep(0.1)
-            while True:
-                id = input("Введите id беседы\n> ")
-                if utils.check_chat_id(id):
-                    downloader = ChatPhotoDownloader(chat_id=id)
-                    loop.run_until_complete(downloader.main())
-                    break
-                else:
-                    logging.info("Беседы с таким id не существует")
-                    time.sleep(0.1)
-            break
-        elif downloader_type == "7":
-            vk = utils.auth_by_token()
+        while True:
             time.sleep(0.1)
-            while True:
-                id = input("Введите id пользователя\n> ")
-                if (utils.check_user_id(id)):
-                    downloader = ChatUserPhotoDownloader(chat_id=id)
-                    loop.run_until_complete(downloader.main())
-                    break
-                else:
-                    logging.info("Пользователя с таким id не существует")
-                    time.sleep(0.1)
-            break
-        else:
-            logging.info("Неправильная команда")
+            downloader_type = input("> ")
+            if downloader_type == "1":
+                vk = utils.auth_by_token()
+                time.sleep(0.1)
+                while True:
+                    id = input("Введите id пользователя\n> ")
+                    if loop.run_until_complete(utils.check_user_id(id)):
+                        downloader = UserPhotoDownloader(user_id=id)
+                        loop.run_until_complete(downloader.main())
+                        break
+                    else:
+                        logging.info("Пользователя с таким id не существует")
+                        time.sleep(0.1)
+                break
+            elif downloader_type == "2":
+                vk = utils.auth_by_token()
+                time.sleep(0.1)
+                while True:
+                    user_ids = input("Введите id пользователей через запятую\n> ")
+                    if loop.run_until_complete(utils.check_user_ids(user_ids)):
+                        downloader = UsersPhotoDownloader(user_ids=user_ids.split(","))
+                        loop.run_until_complete(downloader.main())
+                        break
+                    else:
+                        logging.info("Пользователей с таким id не существует")
+                        time.sleep(0.1)
+                break
+            elif downloader_type == "3":
+                vk = utils.auth_by_token()
+                time.sleep(0.1)
+                while True:
+                    id = input("Введите id группы \n> ")
+                    if loop.run_until_complete(utils.check_group_id(id)):
+                        downloader = GroupPhotoDownloader(group_id=id)
+                        loop.run_until_complete(downloader.main())
+                        break
+                    else:
+                        logging.info("Группы с таким id не существует")
+                        time.sleep(0.1)
+                break
+            elif downloader_type == "4":
+                vk = utils.auth_by_token()
+                time.sleep(0.1)
+                while True:
+                    group_ids = input("Введите id групп через запятую\n> ")
+                    if loop.run_until_complete(utils.check_group_ids(group_ids)):
+                        downloader = GroupsPhotoDownloader(group_ids=group_ids)
+                        loop.run_until_complete(downloader.main())
+                        break
+                    else:
+                        logging.info("Групп с таким id не существует")
+                        time.sleep(0.1)
+                break
+            elif downloader_type == "5":
+                vk = utils.auth_by_token()
+                time.sleep(0.1)
+                while True:
+                    id = input("Введите id беседы\n> ")
+                    if loop.run_until_complete(utils.check_chat_id(id)):
+                        downloader = ChatMembersPhotoDownloader(chat_id=id)
+                        loop.run_until_complete(downloader.main())
+                        break
+                    else:
+                        logging.info("Беседы с таким id не существует")
+                        time.sleep(0.1)
+                break
+            elif downloader_type == "6":
+                vk = utils.auth_by_token()
+                time.sleep(0.1)
+                while True:
+                    id = input("Введите id беседы\n> ")
+                    if loop.run_until_complete(utils.check_chat_id(id)):
+                        downloader = ChatPhotoDownloader(chat_id=id)
+                        loop.run_until_complete(downloader.main())
+                        break
+                    else:
+                        logging.info("Беседы с таким id не существует")
+                        time.sleep(0.1)
+                break
+            elif downloader_type == "7":
+                vk = utils.auth_by_token()
+                time.sleep(0.1)
+                while True:
+                    id = input("Введите id пользователя\n> ")
+                    if (loop.run_until_complete(utils.check_user_id(id))):
+                        downloader = ChatUserPhotoDownloader(chat_id=id)
+                        loop.run_until_complete(downloader.main())
+                        break
+                    else:
+                        logging.info("Пользователя с таким id не существует")
+                        time.sleep(0.1)
+                break
+            elif downloader_type == "8":
+                cache = HashCache(DOWNLOADS_DIR.joinpath(HASH_CACHE_FILENAME))
+                for photos_path in DOWNLOADS_DIR.iterdir():
+                    if photos_path.is_dir() and photos_path.name != STORE_DIRNAME:
+                        dublicates_count = check_for_duplicates(photos_path, recursive=True, cache=cache)
+                        logging.info(f"'{photos_path.name}': дубликатов удалено {dublicates_count}")
+                cache.close()
+                break
+            elif downloader_type == "9":
+                count, size = ContentStore(DOWNLOADS_DIR.joinpath(STORE_DIRNAME)).gc()
+                logging.info(f"Удалено файлов: {count}, освобождено {size / 1024 / 1024:.1f} МБ")
+                break
+            elif downloader_type == "10":
+                actions = {"1": "report", "2": "hardlink", "3": "delete"}
+                action = input("Что делать с похожими фото? 1-только показать 2-заменить ссылками 3-удалить\n> ")
+                if action not in actions:
+                    logging.info("Введено некорректное значение")
+                    continue
+                # numpy и Pillow нужны только здесь
+                from similar import find_similar
+                for photos_path in DOWNLOADS_DIR.iterdir():
+                    if photos_path.is_dir() and photos_path.name != STORE_DIRNAME:
+                        similar = find_similar(photos_path, action=actions[action])
+                        for file_path, original_path, distance in similar:
+                            logging.info(f"{file_path} похоже на {original_path} (расстояние {distance})")
+                        logging.info(f"'{photos_path.name}': похожих фото {len(similar)}")
+                break
+            elif downloader_type == "11":
+                for dir, photos in state.get_failed().items():
+                    logging.info(f"'{dir}': повторяем загрузку {len(photos)} фото")
+                    loop.run_until_complete(download_photos(DOWNLOADS_DIR.joinpath(dir), photos, limiter, state, store))
+                break
+            else:
+                logging.info("Неправильная команда")
+
+    loop.run_until_complete(transport.close())
+    transport.log_report()
+    logging.info("Кэш метаданных: попаданий {hits}, промахов {misses}".format(**metadata.report()))
+    log_savings()
+    metadata.close()
+    state.close()
+
+    if args.report:
+        metrics.save(args.report)
+        logging.info(f"Отчёт о производительности сохранён в {args.report}")
 
     if VK_CONFIG_PATH.exists():
-        VK_CONFIG_PATH.unlink()
\ No newline at end of file
+        VK_CONFIG_PATH.unlink()
+
+    sys.exit(exit_code)
\ No newline at end of file
@@ -0,0 +1,146 @@
+import json
+import time
+import random
+from collections import defaultdict
+from contextlib import contextmanager
+from pathlib import Path
+
+
+BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, float("inf"))
+SAMPLE_SIZE = 10000  # Сколько значений гистограммы хранится для подсчёта p50/p99
+
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS)
+        self.sum = 0.0
+        self.count = 0
+        self.values = []
+
+    def observe(self, value: float):
+        self.count += 1
+        self.sum += value
+        # Равномерная выборка: память не растёт на длинных прогонах
+        if len(self.values) < SAMPLE_SIZE:
+            self.values.append(value)
+        else:
+            i = random.randrange(self.count)
+            if i < SAMPLE_SIZE:
+                self.values[i] = value
+        for i, bound in enumerate(BUCKETS):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+
+    def quantile(self, q: float) -> float:
+        if not self.values:
+            return 0.0
+        values = sorted(self.values)
+        return values[min(len(values) - 1, int(len(values) * q))]
+
+    def report(self) -> dict:
+        return {
+            "count": self.count,
+            "sum": round(self.sum, 3),
+            "p50": round(self.quantile(0.5), 4),
+            "p99": round(self.quantile(0.99), 4)
+        }
+
+
+class Metrics:
+    """
+    Счётчики, значения и гистограммы по этапам работы (запросы к API, обход,
+    очередь загрузки, загрузка, поиск дубликатов). Метрика задаётся именем
+    и метками, например metrics.inc("api_calls_total", method="wall.get").
+    Итог можно сохранить в JSON или отдавать в формате Prometheus
+    """
+
+    def __init__(self):
+        self.started_at = time.time()
+        self.counters = defaultdict(float)
+        self.gauges = {}
+        self.peaks = {}
+        self.histograms = defaultdict(Histogram)
+
+    @staticmethod
+    def get_key(name: str, labels: dict) -> tuple:
+        return name, tuple(sorted(labels.items()))
+
+    def inc(self, name: str, value=1, **labels):
+        self.counters[self.get_key(name, labels)] += value
+
+    def set(self, name: str, value, **labels):
+        key = self.get_key(name, labels)
+        self.gauges[key] = value
+        self.peaks[key] = max(self.peaks.get(key, value), value)
+
+    def observe(self, name: str, value: float, **labels):
+        self.histograms[self.get_key(name, labels)].observe(value)
+
+    @contextmanager
+    def timer(self, name: str, **labels):
+        time_start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(name, time.monotonic() - time_start, **labels)
+
+    @staticmethod
+    def format_key(key: tuple) -> str:
+        name, labels = key
+        if not labels:
+            return name
+        return "{}{{{}}}".format(name, ",".join(f'{label}="{value}"' for label, value in labels))
+
+    def report(self) -> dict:
+        return {
+            "started_at": int(self.started_at),
+            "seconds": round(time.time() - self.started_at, 2),
+            "counters": {self.format_key(key): value for key, value in sorted(self.counters.items())},
+            "gauges": {
+                self.format_key(key): {"value": value, "peak": self.peaks[key]}
+                for key, value in sorted(self.gauges.items())
+            },
+            "histograms": {
+                self.format_key(key): histogram.report()
+                for key, histogram in sorted(self.histograms.items())
+            }
+        }
+
+    def save(self, path: Path):
+        with open(path, "w", encoding="utf-8") as file:
+            json.dump(self.report(), file, ensure_ascii=False, indent=2)
+
+    def to_prometheus(self) -> str:
+        lines = []
+        for key, value in sorted(self.counters.items()):
+            lines.append(f"{self.format_key(key)} {value}")
+        for key, value in sorted(self.gauges.items()):
+            lines.append(f"{self.format_key(key)} {value}")
+        for (name, labels), histogram in sorted(self.histograms.items()):
+            cumulative = 0
+            for bound, count in zip(BUCKETS, histogram.counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else bound
+                lines.append(f"{self.format_key((name + '_bucket', labels + (('le', le),)))} {cumulative}")
+            lines.append(f"{self.format_key((name + '_sum', labels))} {histogram.sum}")
+            lines.append(f"{self.format_key((name + '_count', labels))} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+    async def start_server(self, port: int, host="127.0.0.1"):
+        """Отдаёт метрики по адресу http://host:port/metrics, пока работает цикл событий"""
+        from aiohttp import web
+
+        async def handle(request):
+            return web.Response(text=self.to_prometheus(), content_type="text/plain")
+
+        app = web.Application()
+        app.router.add_get("/metrics", handle)
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, host, port).start()
+        return runner
+
+
+# Общие для всего процесса метрики
+metrics = Metrics()
@@ -0,0 +1,65 @@
+import asyncio
+
+
+USERS_GET_LIMIT = 1000  # Максимум id в одном вызове users.get
+# first_name и last_name users.get возвращает всегда
+PROFILE_FIELDS = ["sex", "is_closed", "can_access_closed", "deactivated", "photo_max_orig"]
+
+
+class ProfileResolver:
+    """
+    Получает профили пользователей пачками по USERS_GET_LIMIT id за вызов users.get
+    и запоминает их, так что проверка id, имя папки и склонение имени
+    берутся из одного запроса. id, запрошенные одновременно из разных задач,
+    уходят одним вызовом, а уже запрошенный профиль повторно не запрашивается.
+    Если передан cache (MetadataCache), профили берутся и из него
+    """
+
+    def __init__(self, cache=None):
+        self.cache = cache
+        self.profiles = {}
+        self.pending = {}
+        self.queued = []
+        self.batch = None
+        self.requests = 0
+
+    async def fetch(self, vk, user_ids: list):
+        self.requests += 1
+        for profile in await vk.users.get(user_ids=user_ids, fields=PROFILE_FIELDS):
+            self.profiles[profile["id"]] = profile
+            if self.cache is not None:
+                self.cache.set(f"user:{profile['id']}", profile)
+
+    async def flush(self, vk):
+        # Ждём один оборот цикла событий, чтобы собрать id из одновременных вызовов
+        await asyncio.sleep(0)
+        user_ids, self.queued, self.batch = self.queued, [], None
+        try:
+            await asyncio.gather(*[
+                self.fetch(vk, user_ids[i:i + USERS_GET_LIMIT])
+                for i in range(0, len(user_ids), USERS_GET_LIMIT)
+            ])
+        finally:
+            for user_id in user_ids:
+                self.pending.pop(user_id, None)
+
+    async def resolve(self, vk, user_ids) -> dict:
+        """Профили по id; несуществующих id в ответе нет"""
+        user_ids = list(dict.fromkeys(int(user_id) for user_id in user_ids))
+        for user_id in user_ids:
+            if user_id in self.profiles or user_id in self.pending:
+                continue
+            cached = self.cache.get(f"user:{user_id}") if self.cache is not None else None
+            if cached is not None:
+                self.profiles[user_id] = cached
+                continue
+            if self.batch is None:
+                self.batch = asyncio.ensure_future(self.flush(vk))
+            self.queued.append(user_id)
+            self.pending[user_id] = self.batch
+
+        await asyncio.gather(*{self.pending[user_id] for user_id in user_ids if user_id in self.pending})
+        return {user_id: self.profiles[user_id] for user_id in user_ids if user_id in self.profiles}
+
+    async def get(self, vk, user_id):
+        return (await self.resolve(vk, [user_id])).get(int(user_id))
@@ -0,0 +1,102 @@
+import time
+import asyncio
+from collections import defaultdict
+
+
+class AdaptiveLimiter:
+    """
+    Ограничивает число одновременных загрузок (всего и на один хост)
+    и подстраивает общий лимит по принципу AIMD:
+    - каждая быстрая успешная загрузка увеличивает лимит на 1/limit,
+      то есть примерно на единицу за «круг» загрузок
+    - ответ 429/503 или ошибка уменьшают лимит вдвое,
+      долгий ответ (дольше target_latency) — на 10%
+    Уменьшение происходит не чаще раза в cooldown секунд,
+    чтобы одна волна ошибок не обрушила лимит до минимума.
+    Если лимитом пользуются несколько владельцев (например, папки разных пользователей),
+    свободный слот достаётся ждущему владельцу с наименьшим числом активных загрузок,
+    поэтому большой профиль не забирает все слоты у остальных
+    """
+
+    def __init__(self, max_limit=64, min_limit=2, per_host=16, initial=8,
+                 target_latency=3.0, cooldown=1.0):
+        self.max_limit = max_limit
+        self.min_limit = min_limit
+        self.per_host = per_host
+        self.target_latency = target_latency
+        self.cooldown = cooldown
+        self.limit = float(min(max(initial, min_limit), max_limit))
+
+        self.active = 0
+        self.active_by_host = defaultdict(int)
+        self.active_by_owner = defaultdict(int)
+        self.waiting_by_owner = defaultdict(int)
+        self.condition = asyncio.Condition()
+        self.last_decrease = 0.0
+
+        self.peak_limit = self.limit
+        self.completed = 0
+        self.errors = 0
+        self.throttled = 0
+
+    def has_slot(self, host: str) -> bool:
+        return self.active < int(self.limit) and self.active_by_host[host] < self.per_host
+
+    def is_turn(self, owner) -> bool:
+        fewest = min(self.active_by_owner.get(waiting, 0) for waiting in self.waiting_by_owner)
+        return self.active_by_owner.get(owner, 0) <= fewest
+
+    async def acquire(self, host: str, owner=None):
+        async with self.condition:
+            self.waiting_by_owner[owner] += 1
+            try:
+                await self.condition.wait_for(lambda: self.has_slot(host) and self.is_turn(owner))
+            finally:
+                self.waiting_by_owner[owner] -= 1
+                if not self.waiting_by_owner[owner]:
+                    del self.waiting_by_owner[owner]
+            self.active += 1
+            self.active_by_host[host] += 1
+            self.active_by_owner[owner] += 1
+            # Очередь могла перейти к другому владельцу
+            self.condition.notify_all()
+
+    async def release(self, host: str, latency: float, status, owner=None):
+        async with self.condition:
+            self.active -= 1
+            self.active_by_host[host] -= 1
+            self.active_by_owner[owner] -= 1
+            if not self.active_by_owner[owner]:
+                del self.active_by_owner[owner]
+            self.update(latency, status)
+            self.condition.notify_all()
+
+    def update(self, latency: float, status):
+        self.completed += 1
+        if status in (429, 503):
+            self.throttled += 1
+            self.decrease(0.5)
+        elif status is None or status < 0 or status >= 500:
+            self.errors += 1
+            self.decrease(0.5)
+        elif latency > self.target_latency:
+            self.decrease(0.9)
+        else:
+            self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+            self.peak_limit = max(self.peak_limit, self.limit)
+
+    def decrease(self, factor: float):
+        now = time.monotonic()
+        if now - self.last_decrease < self.cooldown:
+            return
+        self.last_decrease = now
+        self.limit = max(self.min_limit, self.limit * factor)
+
+    def report(self) -> dict:
+        return {
+            "limit": int(self.limit),
+            "peak_limit": int(self.peak_limit),
+            "completed": self.completed,
+            "errors": self.errors,
+            "throttled": self.throttled
+        }
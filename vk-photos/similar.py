@@ -0,0 +1,170 @@
+import os
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+from PIL import Image
+
+from filter import scan_media
+
+
+IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".gif", ".webp"}
+HASH_BATCH = 256
+PHASH_SIZE = 32
+
+
+def load_gray(file_path: str, width: int, height: int):
+    try:
+        with Image.open(file_path) as image:
+            # Для JPEG уменьшение происходит прямо при декодировании, это в разы быстрее
+            image.draft("L", (width * 4, height * 4))
+            return np.asarray(image.convert("L").resize((width, height), Image.BILINEAR), dtype=np.float32)
+    except Exception:
+        return None
+
+
+def pack_bits(bits: np.ndarray) -> list:
+    """(n, 64) массив bool -> список 64-битных чисел"""
+    return np.packbits(bits.reshape(len(bits), 64), axis=1).view(">u8").ravel().tolist()
+
+
+def dct_matrix(size: int) -> np.ndarray:
+    n = np.arange(size)
+    matrix = np.cos(np.pi * (2 * n[None, :] + 1) * n[:, None] / (2 * size))
+    matrix[0] /= np.sqrt(2)
+    return matrix.astype(np.float32)
+
+
+def hash_batch(file_paths: list, method="dhash") -> list:
+    """
+    Считает перцептивные хеши пачки картинок сразу для всей пачки:
+    dHash — знак разности соседних пикселей картинки 9x8,
+    pHash — знак низкочастотных коэффициентов DCT картинки 32x32 относительно медианы.
+    Для нечитаемых файлов возвращает None
+    """
+    size = (9, 8) if method == "dhash" else (PHASH_SIZE, PHASH_SIZE)
+    images = [load_gray(file_path, *size) for file_path in file_paths]
+    loaded = [i for i, image in enumerate(images) if image is not None]
+    result = [None] * len(file_paths)
+    if not loaded:
+        return result
+
+    batch = np.stack([images[i] for i in loaded])
+    if method == "dhash":
+        bits = batch[:, :, 1:] > batch[:, :, :-1]
+    else:
+        matrix = dct_matrix(PHASH_SIZE)
+        coefficients = (matrix @ batch @ matrix.T)[:, :8, :8].reshape(len(batch), 64)
+        # Постоянную составляющую не учитываем при подсчёте медианы
+        median = np.median(coefficients[:, 1:], axis=1, keepdims=True)
+        bits = coefficients > median
+
+    for i, value in zip(loaded, pack_bits(bits)):
+        result[i] = value
+    return result
+
+
+def hamming(a: int, b: int) -> int:
+    return bin(a ^ b).count("1")
+
+
+class HammingIndex:
+    """
+    Multi-index hashing: 64-битный хеш делится на threshold + 1 частей.
+    Если расстояние Хэмминга между хешами не больше threshold, то хотя бы одна
+    часть совпадает точно, поэтому кандидаты ищутся по словарям частей,
+    а не перебором всех хешей
+    """
+
+    def __init__(self, threshold=4, bits=64):
+        self.threshold = threshold
+        parts = threshold + 1
+        self.masks = [
+            (start, (1 << (end - start)) - 1)
+            for start, end in ((bits * i // parts, bits * (i + 1) // parts) for i in range(parts))
+        ]
+        self.tables = [defaultdict(list) for _ in self.masks]
+        self.hashes = []
+
+    def add(self, value: int) -> int:
+        item_id = len(self.hashes)
+        self.hashes.append(value)
+        for table, (shift, mask) in zip(self.tables, self.masks):
+            table[(value >> shift) & mask].append(item_id)
+        return item_id
+
+    def query(self, value: int):
+        """Ближайший хеш в пределах threshold: (id, расстояние) или None"""
+        best = None
+        checked = set()
+        for table, (shift, mask) in zip(self.tables, self.masks):
+            for item_id in table.get((value >> shift) & mask, ()):
+                if item_id in checked:
+                    continue
+                checked.add(item_id)
+                distance = hamming(value, self.hashes[item_id])
+                if distance <= self.threshold and (best is None or distance < best[1]):
+                    best = (item_id, distance)
+        return best
+
+
+def replace_with_link(original_path, file_path):
+    """
+    Ссылка создаётся под временным именем рядом с файлом и подменяет его через os.replace,
+    поэтому если ссылку создать нельзя (EMLINK, нет прав, ФС без жёстких ссылок),
+    файл остаётся на месте
+    """
+    link_path = f"{file_path}.link"
+    os.link(original_path, link_path)
+    try:
+        os.replace(link_path, file_path)
+    except OSError:
+        os.unlink(link_path)
+        raise
+
+
+def find_similar(path: Path, recursive=True, threshold=4, method="dhash",
+                 action="report", workers=None) -> list:
+    """
+    Ищет почти одинаковые картинки (одно фото, пережатое в разном размере и качестве).
+    Из каждой группы остаётся самый большой файл, остальные в зависимости от action:
+    "report" — только попадают в отчёт, "hardlink" — заменяются ссылкой на оставленный,
+    "delete" — удаляются.
+    Возвращает список (похожий файл, оставленный файл, расстояние)
+    """
+    files = [
+        (file_path, stat.st_size) for file_path, stat in scan_media(path, recursive)
+        if os.path.splitext(file_path)[1].lower() in IMAGE_EXTENSIONS
+    ]
+    # Самые большие файлы — как правило, лучшее качество, их и оставляем
+    files.sort(key=lambda file: file[1], reverse=True)
+    file_paths = [file_path for file_path, _ in files]
+
+    batches = [file_paths[i:i + HASH_BATCH] for i in range(0, len(file_paths), HASH_BATCH)]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        hashes = [
+            value for batch in executor.map(hash_batch, batches, [method] * len(batches))
+            for value in batch
+        ]
+
+    index = HammingIndex(threshold)
+    kept = []
+    similar = []
+    for file_path, value in zip(file_paths, hashes):
+        if value is None:
+            continue
+        match = index.query(value)
+        if match is None:
+            index.add(value)
+            kept.append(file_path)
+        else:
+            similar.append((file_path, kept[match[0]], match[1]))
+
+    for file_path, original_path, _ in similar:
+        if action == "delete":
+            os.unlink(file_path)
+        elif action == "hardlink":
+            replace_with_link(original_path, file_path)
+
+    return similar
@@ -0,0 +1,118 @@
+import logging
+
+from metrics import metrics
+
+
+# Типы размеров фото VK и наибольшая сторона каждого
+# (https://dev.vk.com/reference/objects/photo-sizes). У старых фото width и height
+# бывают равны 0, тогда размер оценивается по типу
+SIZE_TYPES = {
+    "s": 75, "m": 130, "o": 130, "p": 200, "q": 320, "r": 510,
+    "x": 604, "y": 807, "z": 1080, "w": 2560
+}
+SIZE_POLICIES = ("max", "long_edge", "type")
+DEFAULT_LONG_EDGE = 1280
+
+
+def get_long_edge(size: dict) -> int:
+    return max(size.get("width") or 0, size.get("height") or 0) or SIZE_TYPES.get(size.get("type"), 0)
+
+
+def get_area(size: dict) -> int:
+    if size.get("width") and size.get("height"):
+        return size["width"] * size["height"]
+    return get_long_edge(size) ** 2
+
+
+class SizePolicy:
+    """
+    Какой размер фото скачивать:
+    max — самый большой по ширине × высоте (оригинал),
+    long_edge:N — самый маленький, у которого большая сторона не меньше N
+    (если таких нет — самый большой),
+    type:T — размер VK типа T (если его нет — самый большой из тех, что не больше T)
+    """
+
+    def __init__(self, policy="max", long_edge=DEFAULT_LONG_EDGE, size_type="w"):
+        if policy not in SIZE_POLICIES:
+            raise ValueError(f"неизвестный размер фото {policy!r}")
+        if policy == "type" and size_type not in SIZE_TYPES:
+            raise ValueError(f"неизвестный тип размера {size_type!r}")
+        self.policy = policy
+        self.long_edge = int(long_edge)
+        self.size_type = size_type
+
+    @classmethod
+    def parse(cls, value: str):
+        """'max', 'long_edge:1280' или 'type:x'"""
+        policy, _, argument = str(value or "max").partition(":")
+        if policy == "long_edge":
+            return cls(policy, long_edge=argument or DEFAULT_LONG_EDGE)
+        if policy == "type":
+            return cls(policy, size_type=argument)
+        return cls(policy)
+
+    @property
+    def name(self) -> str:
+        if self.policy == "long_edge":
+            return f"long_edge:{self.long_edge}"
+        if self.policy == "type":
+            return f"type:{self.size_type}"
+        return "max"
+
+    def choose(self, sizes: list) -> dict:
+        largest = max(sizes, key=get_area)
+        if self.policy == "long_edge":
+            fitting = [size for size in sizes if get_long_edge(size) >= self.long_edge]
+            return min(fitting, key=get_area) if fitting else largest
+        if self.policy == "type":
+            for size in sizes:
+                if size.get("type") == self.size_type:
+                    return size
+            limit = SIZE_TYPES[self.size_type]
+            smaller = [size for size in sizes if get_long_edge(size) <= limit]
+            return max(smaller, key=get_area) if smaller else largest
+        return largest
+
+    def pick(self, photo: dict) -> dict:
+        """
+        Поля для записи фото: url выбранного размера и во сколько раз
+        самый большой размер больше выбранного (для оценки экономии)
+        """
+        sizes = [size for size in photo["sizes"] if size.get("url")]
+        chosen = self.choose(sizes)
+        largest = max(sizes, key=get_area)
+        return {
+            "url": chosen["url"],
+            "size_policy": self.name,
+            "size_scale": get_area(largest) / max(1, get_area(chosen))
+        }
+
+
+def record_savings(photo: dict, size: int, seconds: float):
+    """
+    Считает скачанное по каждому правилу выбора размера и оценивает, сколько байт
+    и секунд загрузки сэкономлено по сравнению с самым большим размером
+    (размер JPEG примерно пропорционален числу пикселей)
+    """
+    policy = photo.get("size_policy")
+    if policy is None:
+        return
+    extra = photo.get("size_scale", 1) - 1
+    metrics.inc("size_policy_photos_total", policy=policy)
+    metrics.inc("size_policy_bytes_total", size, policy=policy)
+    metrics.inc("size_policy_bytes_saved_estimate", size * extra, policy=policy)
+    metrics.inc("size_policy_seconds_saved_estimate", seconds * extra, policy=policy)
+
+
+def log_savings():
+    """Итог по каждому правилу выбора размера, которое использовалось в этом запуске"""
+    for (name, labels), downloaded in sorted(metrics.counters.items()):
+        if name != "size_policy_bytes_total":
+            continue
+        labels = dict(labels)
+        saved_bytes = metrics.counters[metrics.get_key("size_policy_bytes_saved_estimate", labels)]
+        saved_seconds = metrics.counters[metrics.get_key("size_policy_seconds_saved_estimate", labels)]
+        logging.info("Размер фото {}: скачано {:.1f} МБ, сэкономлено примерно {:.1f} МБ и {:.0f} с загрузки".format(
+            labels["policy"], downloaded / 1024 / 1024, saved_bytes / 1024 / 1024, saved_seconds
+        ))
@@ -0,0 +1,150 @@
+import time
+import sqlite3
+from pathlib import Path
+
+
+STATE_FILENAME = "sync.sqlite3"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS photos (
+    dir TEXT NOT NULL,
+    owner_id INTEGER NOT NULL,
+    id INTEGER NOT NULL,
+    url TEXT,
+    date INTEGER,
+    size INTEGER,
+    hash TEXT,
+    PRIMARY KEY (dir, owner_id, id)
+);
+CREATE INDEX IF NOT EXISTS photos_by_id ON photos (owner_id, id);
+CREATE TABLE IF NOT EXISTS failed (
+    dir TEXT NOT NULL,
+    owner_id INTEGER NOT NULL,
+    id INTEGER NOT NULL,
+    url TEXT,
+    date INTEGER,
+    error TEXT,
+    attempts INTEGER NOT NULL,
+    updated_at INTEGER NOT NULL,
+    PRIMARY KEY (dir, owner_id, id)
+);
+CREATE TABLE IF NOT EXISTS sources (
+    source TEXT PRIMARY KEY,
+    newest INTEGER NOT NULL,
+    synced_at INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS page_cursors (
+    source TEXT PRIMARY KEY,
+    cursor TEXT NOT NULL,
+    updated_at INTEGER NOT NULL
+);
+"""
+
+
+class SyncState:
+    """
+    Манифест скачанных фото, который лежит в корне папки загрузок.
+    Для каждого фото хранится папка, (owner_id, id), ссылка, дата, размер и хеш,
+    для каждого источника (стена группы, фото пользователя) — самая новая
+    запись, до которой он был полностью синхронизирован, а для недокачанных
+    постраничных обходов (вложения переписки) — курсор, с которого обход можно продолжить.
+    Фото, которые не удалось скачать, попадают в журнал ошибок (таблица failed)
+    """
+
+    def __init__(self, root: Path):
+        self.root = root
+        self.db = sqlite3.connect(root.joinpath(STATE_FILENAME))
+        self.db.executescript(SCHEMA)
+        self.photos = set(self.db.execute("SELECT dir, owner_id, id FROM photos"))
+
+    def get_dir(self, photos_path: Path) -> str:
+        try:
+            return str(photos_path.relative_to(self.root))
+        except ValueError:
+            return str(photos_path)
+
+    def has_photo(self, photos_path: Path, owner_id: int, photo_id: int) -> bool:
+        return (self.get_dir(photos_path), owner_id, photo_id) in self.photos
+
+    def add_photo(self, photos_path: Path, photo: dict, size: int, digest: str):
+        key = (self.get_dir(photos_path), photo["owner_id"], photo["id"])
+        self.photos.add(key)
+        self.db.execute(
+            "INSERT OR REPLACE INTO photos VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (*key, photo["url"], photo.get("date"), size, digest)
+        )
+
+    def get_hashes(self, photos_path: Path) -> list:
+        return [row[0] for row in self.db.execute(
+            "SELECT hash FROM photos WHERE dir = ? AND hash IS NOT NULL", (self.get_dir(photos_path),)
+        )]
+
+    def find_hash(self, owner_id: int, photo_id: int):
+        """Хеш и размер фото, если оно уже скачивалось в любую папку"""
+        return self.db.execute(
+            "SELECT hash, size FROM photos WHERE owner_id = ? AND id = ? AND hash IS NOT NULL LIMIT 1",
+            (owner_id, photo_id)
+        ).fetchone()
+
+    def add_failed(self, photos_path: Path, photo: dict, error: str):
+        key = (self.get_dir(photos_path), photo["owner_id"], photo["id"])
+        self.db.execute(
+            "INSERT INTO failed VALUES (?, ?, ?, ?, ?, ?, 1, ?) "
+            "ON CONFLICT (dir, owner_id, id) DO UPDATE SET "
+            "url = excluded.url, error = excluded.error, "
+            "attempts = attempts + 1, updated_at = excluded.updated_at",
+            (*key, photo["url"], photo.get("date"), error, int(time.time()))
+        )
+
+    def remove_failed(self, photos_path: Path, photo: dict):
+        self.db.execute(
+            "DELETE FROM failed WHERE dir = ? AND owner_id = ? AND id = ?",
+            (self.get_dir(photos_path), photo["owner_id"], photo["id"])
+        )
+
+    def get_failed(self) -> dict:
+        """Фото из журнала ошибок, сгруппированные по папкам"""
+        failed = {}
+        for dir, owner_id, photo_id, url, date in self.db.execute(
+            "SELECT dir, owner_id, id, url, date FROM failed"
+        ):
+            failed.setdefault(dir, []).append({"owner_id": owner_id, "id": photo_id, "url": url, "date": date})
+        return failed
+
+    def get_cursor(self, source: str):
+        row = self.db.execute("SELECT newest FROM sources WHERE source = ?", (source,)).fetchone()
+        return row[0] if row else None
+
+    def set_cursor(self, source: str, newest: int):
+        self.db.execute(
+            "INSERT OR REPLACE INTO sources VALUES (?, ?, ?)",
+            (source, newest, int(time.time()))
+        )
+        self.commit()
+
+    def get_page_cursor(self, source: str):
+        row = self.db.execute("SELECT cursor FROM page_cursors WHERE source = ?", (source,)).fetchone()
+        return row[0] if row else None
+
+    def set_page_cursor(self, source: str, cursor):
+        """
+        Запоминает курсор недокачанного обхода, None — обход завершён.
+        Сначала фиксируются записи манифеста и журнала ошибок, а курсор — отдельно после них:
+        после сбоя курсор не может оказаться впереди фото, которые по нему пропускаются
+        """
+        self.commit()
+        if cursor is None:
+            self.db.execute("DELETE FROM page_cursors WHERE source = ?", (source,))
+        else:
+            self.db.execute(
+                "INSERT OR REPLACE INTO page_cursors VALUES (?, ?, ?)",
+                (source, cursor, int(time.time()))
+            )
+        self.commit()
+
+    def commit(self):
+        self.db.commit()
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
@@ -0,0 +1,85 @@
+import os
+import sys
+import errno
+import shutil
+
+try:
+    import fcntl
+except ImportError:
+    # Windows: копий через reflink нет, файлы просто копируются
+    fcntl = None
+from pathlib import Path
+
+
+STORE_DIRNAME = ".store"
+FICLONE = 0x40049409  # ioctl для reflink (btrfs, xfs)
+
+
+class ContentStore:
+    """
+    Хранилище, в котором каждое уникальное фото лежит один раз под своим хешем,
+    а в папках пользователей, групп и бесед — только жёсткие ссылки на него
+    (или reflink/копия, если ссылку создать нельзя)
+    """
+
+    def __init__(self, root: Path):
+        self.root = root
+        self.root.mkdir(exist_ok=True)
+
+    def get_path(self, digest: str) -> Path:
+        return self.root.joinpath(digest[:2], digest)
+
+    def has(self, digest: str) -> bool:
+        return self.get_path(digest).exists()
+
+    def add(self, part_path: Path, digest: str) -> Path:
+        """Переносит скачанный файл в хранилище, если такого там ещё нет"""
+        blob_path = self.get_path(digest)
+        if blob_path.exists():
+            part_path.unlink()
+        else:
+            blob_path.parent.mkdir(exist_ok=True)
+            os.replace(part_path, blob_path)
+        return blob_path
+
+    def link(self, digest: str, photo_path: Path):
+        blob_path = self.get_path(digest)
+        try:
+            os.link(blob_path, photo_path)
+        except FileExistsError:
+            pass
+        except OSError as e:
+            # Например, папка загрузок на другом диске или в FAT32
+            if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOTSUP):
+                raise
+            self.clone(blob_path, photo_path)
+
+    @staticmethod
+    def clone(blob_path: Path, photo_path: Path):
+        with open(blob_path, "rb") as src, open(photo_path, "wb") as dst:
+            try:
+                if fcntl is None:
+                    raise OSError(errno.EOPNOTSUPP, "reflink недоступен")
+                fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+            except OSError:
+                shutil.copyfileobj(src, dst)
+
+    def gc(self) -> tuple:
+        """Удаляет файлы, на которые не ссылается ни одна папка. Возвращает их количество и объём"""
+        count, size = 0, 0
+        for blob_path in self.root.glob("*/*"):
+            stat = blob_path.stat()
+            if stat.st_nlink == 1:
+                blob_path.unlink()
+                count += 1
+                size += stat.st_size
+        return count, size
+
+
+if __name__ == "__main__":
+    # python vk-photos/storage.py gc <папка загрузок>
+    if len(sys.argv) != 3 or sys.argv[1] != "gc":
+        print("Использование: storage.py gc <папка загрузок>")
+        sys.exit(1)
+    count, size = ContentStore(Path(sys.argv[2]).joinpath(STORE_DIRNAME)).gc()
+    print(f"Удалено файлов: {count}, освобождено {size / 1024 / 1024:.1f} МБ")
@@ -0,0 +1,101 @@
+import ssl
+import logging
+
+import aiohttp
+
+from metrics import metrics
+
+
+# Значения по умолчанию; в main берутся из config.yaml
+CONNECTIONS = 100  # Всего открытых соединений
+CONNECTIONS_PER_HOST = 32  # Соединений с одним сервером (не меньше per_host_concurrency)
+KEEPALIVE = 60  # Сколько секунд держать простаивающее соединение
+DNS_TTL = 300  # Сколько секунд кэшировать адреса серверов
+
+
+class Transport:
+    """
+    Одна на весь процесс сессия aiohttp для запросов к API и загрузки фото со всех источников.
+    Соединения (вместе с TLS) переиспользуются между пользователями, группами и беседами,
+    адреса серверов sun*.userapi.com кэшируются. Новые и повторно использованные
+    соединения и попадания в кэш DNS считаются в metrics
+    """
+
+    def __init__(self, connections=CONNECTIONS, connections_per_host=CONNECTIONS_PER_HOST,
+                 keepalive=KEEPALIVE, dns_ttl=DNS_TTL):
+        self.configure(connections, connections_per_host, keepalive, dns_ttl)
+        self.session = None
+        # Один SSL контекст на все соединения; создаётся с первой сессией,
+        # потому что чтение сертификатов заметно замедляет запуск
+        self.ssl_context = None
+
+    def configure(self, connections=CONNECTIONS, connections_per_host=CONNECTIONS_PER_HOST,
+                  keepalive=KEEPALIVE, dns_ttl=DNS_TTL):
+        """Настройки применяются к следующей созданной сессии"""
+        self.connections = connections
+        self.connections_per_host = connections_per_host
+        self.keepalive = keepalive
+        self.dns_ttl = dns_ttl
+
+    @staticmethod
+    def get_trace_config() -> aiohttp.TraceConfig:
+        async def on_create(session, context, params):
+            metrics.inc("http_connections_total", kind="new")
+
+        async def on_reuse(session, context, params):
+            metrics.inc("http_connections_total", kind="reused")
+
+        async def on_dns_hit(session, context, params):
+            metrics.inc("http_dns_total", result="hit")
+
+        async def on_dns_miss(session, context, params):
+            metrics.inc("http_dns_total", result="miss")
+
+        trace_config = aiohttp.TraceConfig()
+        trace_config.on_connection_create_end.append(on_create)
+        trace_config.on_connection_reuseconn.append(on_reuse)
+        trace_config.on_dns_cache_hit.append(on_dns_hit)
+        trace_config.on_dns_cache_miss.append(on_dns_miss)
+        return trace_config
+
+    def get_session(self) -> aiohttp.ClientSession:
+        if self.session is None or self.session.closed:
+            if self.ssl_context is None:
+                self.ssl_context = ssl.create_default_context()
+            connector = aiohttp.TCPConnector(
+                limit=self.connections,
+                limit_per_host=self.connections_per_host,
+                keepalive_timeout=self.keepalive,
+                ttl_dns_cache=self.dns_ttl,
+                ssl=self.ssl_context
+            )
+            self.session = aiohttp.ClientSession(
+                connector=connector,
+                trace_configs=[self.get_trace_config()]
+            )
+        return self.session
+
+    def report(self) -> dict:
+        new = metrics.counters.get(metrics.get_key("http_connections_total", {"kind": "new"}), 0)
+        reused = metrics.counters.get(metrics.get_key("http_connections_total", {"kind": "reused"}), 0)
+        return {
+            "new": int(new),
+            "reused": int(reused),
+            "reuse_ratio": reused / (new + reused) if new + reused else 0.0
+        }
+
+    def log_report(self):
+        report = self.report()
+        if report["new"] or report["reused"]:
+            logging.info("HTTP-соединений: новых {new}, повторно использованных {reused} ({:.0%})".format(
+                report["reuse_ratio"], **report
+            ))
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+
+# Общий для всего процесса транспорт
+transport = Transport()